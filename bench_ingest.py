@@ -0,0 +1,53 @@
+"""measures the time `Data` needs to ingest a large prediction input (`add_external_data`, `compute_features`).
+
+    python bench_ingest.py --rows 1000000
+writes a synthetic external TSV (unique dummy SMILES, which are not parsed during ingestion) with `--rows` rows
+and the setup of `--input_metadata`, and reports the time of each step."""
+from tap import Tap
+from time import perf_counter
+import tempfile
+import os
+import numpy as np
+import pandas as pd
+
+class BenchArgs(Tap):
+    rows: int = 1_000_000                                # number of rows of the synthetic input
+    input_metadata: str = 'test/test_metadata.yaml'      # setup (yaml) used for all rows
+    input_compounds: str = 'test/test_input.tsv'         # SMILES to build the dummy SMILES from
+    repeats: int = 3                                     # number of measurements (the minimum is reported)
+
+def write_input(path, rows, smiles):
+    df = pd.DataFrame({'smiles': [f'{smiles[i % len(smiles)]}.{i}' for i in range(rows)]})
+    df['rt'] = np.where(np.arange(rows) % 2 == 0, np.linspace(1, 20, rows), np.nan)
+    df.to_csv(path, sep='\t', index=False)
+
+def ingest(path, metadata):
+    from utils import Data
+    times = {}
+    t0 = perf_counter()
+    df = pd.read_csv(path, sep='\t', dtype={'dataset_id': str})
+    times['read_csv'] = perf_counter() - t0
+    d = Data()
+    t0 = perf_counter()
+    d.add_external_data(df, metadata=metadata, remove_nan_rts=False, tab_mode=True, isomeric=True,
+                        split_type='evaluate', name=path)
+    times['add_external_data'] = perf_counter() - t0
+    t0 = perf_counter()
+    d.compute_features(mode=None, add_descs=False)
+    times['compute_features'] = perf_counter() - t0
+    assert len(d.df) == len(df) and len(d.x_features) == len(df)
+    return times
+
+if __name__ == '__main__':
+    args = BenchArgs().parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    from predict import load_metadata
+    metadata = load_metadata(args.input_metadata)
+    smiles = pd.read_csv(args.input_compounds, sep='\t')['smiles.std'].dropna().tolist()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'external.tsv')
+        write_input(path, args.rows, smiles)
+        results = [ingest(path, metadata) for _ in range(args.repeats)]
+    for step in results[0]:
+        print(f'{step}: {min(r[step] for r in results):.3f}s')
+    print(f'total: {min(sum(r.values()) for r in results):.3f}s ({args.rows} rows, min of {args.repeats} runs)')
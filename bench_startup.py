@@ -0,0 +1,60 @@
+"""measures the import time of the inference entry points in fresh interpreters and checks it against a budget.
+
+    python bench_startup.py --budget 1.0
+exits with a non-zero status if the median import time exceeds the budget."""
+from tap import Tap
+from typing import List
+import subprocess
+import sys
+import os
+import re
+import numpy as np
+
+# should not be needed just for starting up
+HEAVY_MODULES = ['torch', 'chemprop', 'sklearn', 'scipy.stats', 'rdkit.Chem.Descriptors', 'pulp', 'scipy.optimize',
+                 'torch.utils.tensorboard', 'statsmodels']
+
+class BenchArgs(Tap):
+    modules: List[str] = ['predict'] # modules to import (e.g., also `mpnranker2` for what loading the model adds)
+    repeats: int = 5                 # number of fresh interpreters to measure
+    budget: float = 1.0              # maximum median import time (seconds)
+    top: int = 10                    # number of slowest imports to report
+
+def run_python(code, *flags):
+    return subprocess.run([sys.executable, *flags, '-c', code], capture_output=True, text=True, check=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+
+def time_import(modules):
+    code = ('import time; t0 = time.perf_counter()\n'
+            + ''.join(f'import {m}\n' for m in modules)
+            + 'print(time.perf_counter() - t0)\n'
+            + 'import sys; print(",".join(m for m in ' + repr(HEAVY_MODULES) + ' if m in sys.modules))')
+    lines = run_python(code).stdout.strip().splitlines()
+    return float(lines[0]), [m for m in lines[1].split(',') if len(m) > 0] if len(lines) > 1 else []
+
+def slowest_imports(modules, top=10):
+    """(self time [s], module) of the slowest imports according to `-X importtime`"""
+    res = run_python(''.join(f'import {m}\n' for m in modules), '-X', 'importtime')
+    times = []
+    for line in res.stderr.splitlines():
+        if (match := re.match(r'import time:\s+(\d+) \|\s+\d+ \|\s*(.*)', line)):
+            times.append((int(match.group(1)) / 1e6, match.group(2).strip()))
+    return sorted(times, reverse=True)[:top]
+
+if __name__ == '__main__':
+    args = BenchArgs().parse_args()
+    times = []
+    for _ in range(args.repeats):
+        t, heavy = time_import(args.modules)
+        times.append(t)
+    median = np.median(times)
+    print(f'import {", ".join(args.modules)}: median {median:.3f}s (min {min(times):.3f}s, '
+          f'max {max(times):.3f}s, {args.repeats} runs)')
+    print('heavy modules imported:', ', '.join(heavy) if len(heavy) > 0 else 'none')
+    print(f'slowest imports (self time):')
+    for t, module in slowest_imports(args.modules, args.top):
+        print(f'  {t:.3f}s {module}')
+    if (median > args.budget):
+        print(f'over budget: {median:.3f}s > {args.budget:.3f}s')
+        sys.exit(1)
+    print(f'within budget ({args.budget:.3f}s)')
@@ -0,0 +1,60 @@
+"""compares the int8 quantized model (`predict.py --quantize`) with the fp32 model:
+ROI rank correlation, retention order accuracy (`eval_`), predicted retention times and throughput.
+
+    python check_quantization.py --model models/twostep_everything_predready.pt --repo_root_folder <path to RepoRT>
+"""
+from logging import basicConfig, INFO, info
+from tap import Tap
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+from predict import load_model, load_metadata, preprocess, predict_rois, map_rts, quantize_model
+from evaluate import eval_
+
+class CheckArgs(Tap):
+    model: str                                             # model to check (output of `repackage_model.py`)
+    input_compounds: str = 'test/test_input.tsv'
+    input_metadata: str = 'test/test_metadata.yaml'
+    repo_root_folder: str = '../RepoRT/'                   # location of RepoRT, needed for HSM/Tanaka database
+    batch_size: int = 256
+    repeats: int = 3                                       # number of timed ROI predictions per model
+    verbose: bool = False
+
+def time_predictions(model, d, graphs, X, X_sys, batch_size, repeats):
+    """ROIs (in the order of `d.df`) and the best time of `repeats` predictions"""
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        rois = predict_rois(model, d, graphs, X, X_sys, batch_size=batch_size).values.copy()
+        times.append(perf_counter() - start)
+    return rois, min(times)
+
+if __name__ == '__main__':
+    args = CheckArgs().parse_args()
+    if (args.verbose):
+        basicConfig(level=INFO)
+    from scipy.stats import spearmanr, kendalltau
+    model = load_model(args.model, all_in_one=True)
+    model_q = quantize_model(model)
+    metadata = load_metadata(args.input_metadata)
+    compounds = pd.read_csv(args.input_compounds, sep='\t', dtype={'dataset_id': str})
+    output_columns = compounds.columns.tolist()
+    d, graphs, X, X_sys = preprocess(model, compounds, metadata, args.repo_root_folder)
+    info('predicting ROIs with the fp32 model...')
+    rois, t_fp32 = time_predictions(model, d, graphs, X, X_sys, args.batch_size, args.repeats)
+    rts = map_rts(d, metadata, output_columns).rt_pred
+    info('predicting ROIs with the int8 model...')
+    rois_q, t_int8 = time_predictions(model_q, d, graphs, X, X_sys, args.batch_size, args.repeats)
+    rts_q = map_rts(d, metadata, output_columns).rt_pred
+    anchors = ~pd.isna(d.df.rt).values
+    print(f'{len(rois)} compounds, {anchors.sum()} with retention times')
+    print(f'ROI rank correlation: spearman {spearmanr(rois, rois_q)[0]:.4f}, kendall {kendalltau(rois, rois_q)[0]:.4f}')
+    # retention order of the fp32 model as reference
+    print(f'pairwise order agreement with fp32 ROIs: {eval_(rois, rois_q, epsilon=0, roi_thr=0):.4f}')
+    if (anchors.sum() > 1):
+        print(f'retention order accuracy (anchors): fp32 {eval_(d.df.rt.values[anchors], rois[anchors]):.4f}, '
+              f'int8 {eval_(d.df.rt.values[anchors], rois_q[anchors]):.4f}')
+    rt_diff = np.abs(rts.values - rts_q.values)
+    print(f'predicted retention time difference: median {np.median(rt_diff):.3f}, max {rt_diff.max():.3f}')
+    print(f'ROI prediction time: fp32 {t_fp32:.2f}s, int8 {t_int8:.2f}s (speedup {t_fp32 / t_int8:.2f}x)')
@@ -0,0 +1,105 @@
+"""persistent cache for molecular descriptor values (`features.features`), replacing the pickled dict.
+
+Values are stored in an SQLite database keyed by (version, SMILES, descriptor), so that
+only the values needed are read, new values are written incrementally in batches (an interrupted run
+loses nothing already written) and several processes can read (and write) the cache at the same time.
+The version of a descriptor (see `features.descriptor_version`) changes with the RDKit version and the
+way its descriptor family is computed; values of other versions are kept in the file, but not used.
+"""
+import os
+import pickle
+from itertools import islice
+import sqlite3
+import logging
+import numpy as np
+
+logger = logging.getLogger('twosteprt.descriptor_cache')
+info = logger.info
+warning = logger.warning
+
+class DescriptorCache:
+    """dict-like ((SMILES, descriptor) -> value) cache in the SQLite file `path`; used as `features.cached`.
+    `get_many` reads the values for a list of SMILES at once, `update` writes new values in one transaction."""
+    def __init__(self, path, version=None, batch_size=10_000):
+        # `version`: descriptor name -> version (default: `features.descriptor_version`) or one version for all
+        if (path.endswith('.pkl')):
+            legacy, path = path, path[:-len('.pkl')] + '.sqlite'
+        else:
+            legacy = None
+        if (version is None):
+            from features import descriptor_version, legacy_descriptor_version
+            version, legacy_version = descriptor_version, legacy_descriptor_version
+        else:
+            legacy_version = version if callable(version) else (lambda descriptor: version)
+        self.path = path
+        self.version = version if callable(version) else (lambda descriptor: version)
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL') # readers don't block the writer and vice versa
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS descriptor_values (version TEXT, smiles TEXT, '
+                                'descriptor TEXT, value REAL, PRIMARY KEY (version, smiles, descriptor)) WITHOUT ROWID')
+        self.connection.commit()
+        if (legacy is not None and os.path.exists(legacy) and len(self) == 0):
+            warning(f'importing the pickled descriptor cache {legacy} into {path} (assuming the same RDKit version; '
+                    'values of outdated descriptor versions, e.g., 3D descriptors, are kept but recomputed)')
+            self.update(pickle.load(open(legacy, 'rb')), version=legacy_version)
+
+    def __len__(self):
+        return sum(n for version, descriptor, n in self.connection.execute(
+            'SELECT version, descriptor, COUNT(*) FROM descriptor_values GROUP BY version, descriptor')
+                   if version == self.version(descriptor))
+
+    def _lookup(self, key):
+        return self.connection.execute('SELECT value FROM descriptor_values WHERE version=? AND smiles=? AND descriptor=?',
+                                       (self.version(key[1]), *key)).fetchone()
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        row = self._lookup(key)
+        if (row is None):
+            raise KeyError(key)
+        return np.nan if row[0] is None else row[0] # NaN is stored as NULL
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def get_many(self, smiles, descriptors=None):
+        """{(SMILES, descriptor): value} for all cached values of `smiles` (and `descriptors`, if given)"""
+        descriptors = set(descriptors) if descriptors is not None else None
+        result = {}
+        with self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS query_smiles (smiles TEXT PRIMARY KEY)')
+            self.connection.execute('DELETE FROM query_smiles')
+            self.connection.executemany('INSERT OR IGNORE INTO query_smiles VALUES (?)', ((s, ) for s in smiles))
+            versions = {}
+            for version, s, descriptor, value in self.connection.execute(
+                    'SELECT v.version, v.smiles, v.descriptor, v.value FROM descriptor_values v JOIN query_smiles q '
+                    'ON v.smiles = q.smiles'):
+                if (descriptor not in versions):
+                    versions[descriptor] = self.version(descriptor)
+                if (version == versions[descriptor] and (descriptors is None or descriptor in descriptors)):
+                    result[(s, descriptor)] = np.nan if value is None else value
+        return result
+
+    def update(self, values, version=None):
+        """adds ((SMILES, descriptor) -> value) mapping or pairs, written in batches of `batch_size`;
+        values are stored with the current version of their descriptor or `version` (descriptor -> version)"""
+        version = version or self.version
+        items = iter(values.items() if hasattr(values, 'items') else values)
+        n = 0
+        while True:
+            batch = [(version(descriptor), s, descriptor, None if value is None or np.isnan(value) else float(value))
+                     for (s, descriptor), value in islice(items, self.batch_size)]
+            if (len(batch) == 0):
+                break
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO descriptor_values VALUES (?, ?, ?, ?)', batch)
+            n += len(batch)
+        if (n > 0):
+            info(f'wrote {n} descriptor values to {self.path}')
+
+    def close(self):
+        self.connection.close()
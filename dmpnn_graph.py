@@ -1,9 +1,129 @@
 from chemprop.features import MolGraph, BatchMolGraph
+import numpy as np
+import copy
+import re
+
+SMILES_ATOM = re.compile(r'\[[^\]]+\]|Br|Cl|[BCNOSPFIbcnosp]')
 
 def dmpnn_graph(smiles, atom_features_extra=None, bond_features_extra=None):
     return MolGraph(smiles, atom_features_extra=atom_features_extra,
                     bond_features_extra=bond_features_extra)
 
+def _features_array(features, n):
+    return (np.asarray(features, dtype=np.float32).reshape(n, -1) if n > 0
+            else np.zeros((0, 0), dtype=np.float32))
+
+def graph_to_arrays(graph):
+    """compact representation of a `MolGraph` as numpy arrays (+ scalar attributes), cheap to pickle and store"""
+    arrays = {k: v for k, v in vars(graph).items() if k not in ('f_atoms', 'f_bonds', 'a2b', 'b2a', 'b2revb')}
+    arrays['f_atoms'] = _features_array(graph.f_atoms, graph.n_atoms)
+    arrays['f_bonds'] = _features_array(graph.f_bonds, graph.n_bonds)
+    arrays['b2a'] = np.asarray(graph.b2a, dtype=np.int32)
+    arrays['b2revb'] = np.asarray(graph.b2revb, dtype=np.int32)
+    return arrays
+
+def graph_from_arrays(arrays):
+    """`MolGraph` from the output of `graph_to_arrays` (without parsing the SMILES again)"""
+    graph = MolGraph.__new__(MolGraph)
+    for k, v in arrays.items():
+        setattr(graph, k, v)
+    graph.f_atoms = arrays['f_atoms'].tolist()
+    graph.f_bonds = arrays['f_bonds'].tolist()
+    graph.b2a = arrays['b2a'].tolist()
+    graph.b2revb = arrays['b2revb'].tolist()
+    # incoming bonds of each atom, in the order they were added
+    graph.a2b = [[] for _ in range(graph.n_atoms)]
+    for b, b_rev in enumerate(graph.b2revb):
+        graph.a2b[graph.b2a[b_rev]].append(b)
+    return graph
+
+def _dmpnn_graph_arrays(smiles):
+    return graph_to_arrays(dmpnn_graph(smiles))
+
+def dmpnn_graphs(smiles, n_jobs=1, chunksize=None):
+    """graphs for a list of SMILES; with `n_jobs` > 1 built by a process pool.
+
+    Workers only send back the feature arrays (see `graph_to_arrays`), pickling full graphs would be
+    about as expensive as building them. The graphs give the same model inputs as the serial path."""
+    if (n_jobs is None or n_jobs <= 1 or len(smiles) < 2):
+        return [dmpnn_graph(s) for s in smiles]
+    import multiprocessing as mp
+    if (chunksize is None):
+        # a few chunks per worker to even out differently sized molecules
+        chunksize = max(1, len(smiles) // (n_jobs * 4))
+    with mp.Pool(n_jobs) as pool:
+        return [graph_from_arrays(arrays) for arrays in
+                pool.imap(_dmpnn_graph_arrays, smiles, chunksize=chunksize)]
+
+def attach_sysfeatures(graph, sysfeatures, bond_or_atom='bond'):
+    """copy of `graph` with the (per-molecule) `sysfeatures` as extra features of all atoms or bonds;
+    same features as featurizing the molecule again with `atom/bond_features_extra`"""
+    if (sysfeatures is None):
+        return graph
+    sysfeatures = np.asarray(sysfeatures).tolist()
+    new_graph = copy.copy(graph)
+    if (bond_or_atom == 'bond'):
+        new_graph.f_bonds = [f_bond + sysfeatures for f_bond in graph.f_bonds]
+    elif (bond_or_atom == 'atom'):
+        # bond features start with the features of their source atom
+        atom_fdim = len(graph.f_atoms[0]) if graph.n_atoms > 0 else 0
+        new_graph.f_atoms = [f_atom + sysfeatures for f_atom in graph.f_atoms]
+        new_graph.f_bonds = [f_bond[:atom_fdim] + sysfeatures + f_bond[atom_fdim:] for f_bond in graph.f_bonds]
+    else:
+        raise NotImplementedError(bond_or_atom)
+    return new_graph
+
+def graph_n_atoms(graph):
+    """number of (heavy) atoms of a graph; estimated for SMILES"""
+    if (isinstance(graph, str)):
+        return len(SMILES_ATOM.findall(graph))
+    return graph.n_atoms
+
+def atom_budget_batches(sizes, max_atoms, max_molecules=None, sort=True):
+    """splits molecules with `sizes` (number of atoms) into batches (index arrays) of at most `max_atoms` atoms
+    and `max_molecules` molecules; with `sort`, similarly sized molecules are batched together.
+    Molecules larger than the budget get their own batch."""
+    order = np.argsort(sizes, kind='stable') if sort else np.arange(len(sizes))
+    batches = []
+    current = []
+    current_atoms = 0
+    for i in order:
+        if (len(current) > 0 and (current_atoms + sizes[i] > max_atoms
+                                  or (max_molecules is not None and len(current) >= max_molecules))):
+            batches.append(np.array(current))
+            current = []
+            current_atoms = 0
+        current.append(i)
+        current_atoms += sizes[i]
+    if (len(current) > 0):
+        batches.append(np.array(current))
+    return batches
+
+def batch_indices(graphs, batch_size, max_batch_atoms=None):
+    """slices of `batch_size` molecules or, with `max_batch_atoms`, index arrays of batches of
+    similarly sized molecules with at most `max_batch_atoms` atoms"""
+    if (max_batch_atoms is None):
+        return [slice(start, start + batch_size) for start in range(0, len(graphs), batch_size)]
+    return atom_budget_batches([graph_n_atoms(g) for g in graphs], max_batch_atoms, max_molecules=batch_size)
+
+def take_batch(items, idx):
+    # (arrays and sparse matrices can be indexed directly)
+    return (items[idx] if isinstance(idx, slice) or isinstance(items, np.ndarray) or hasattr(items, 'tocsr')
+            else [items[j] for j in idx])
+
+def dense_batch(values):
+    """batch of (extra/system) features as dense array; features may be stored as scipy sparse matrix"""
+    return values.toarray() if hasattr(values, 'toarray') else np.asarray(values)
+
+def restore_order(results, batches):
+    """concatenates per-batch `results` in the original order of the molecules"""
+    results = np.concatenate(results)
+    if (all(isinstance(idx, slice) for idx in batches)):
+        return results
+    ordered = np.empty_like(results)
+    ordered[np.concatenate(batches)] = results
+    return ordered
+
 def dmpnn_batch(graphs):
     return  BatchMolGraph(graphs)
 
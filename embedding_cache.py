@@ -0,0 +1,81 @@
+"""cache for molecule encodings, which (without system features in the graphs) are the same for every chromatographic system"""
+import hashlib
+import os
+import logging
+import numpy as np
+
+logger = logging.getLogger('twosteprt.embedding_cache')
+info = logger.info
+warning = logger.warning
+
+def _hash_value(h, value):
+    import torch
+    if (torch.is_tensor(value)):
+        if (value.is_quantized):
+            h.update(b'quantized')
+            value = value.dequantize()
+        h.update(value.detach().cpu().numpy().tobytes())
+    elif (isinstance(value, (tuple, list))):
+        # e.g., packed parameters of quantized layers
+        for v in value:
+            _hash_value(h, v)
+    else:
+        h.update(repr(value).encode('utf-8'))
+
+def model_hash(model):
+    """content hash of all model parameters; identifies the model independent of its file name"""
+    h = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        h.update(name.encode('utf-8'))
+        _hash_value(h, value)
+    return h.hexdigest()[:16]
+
+class EmbeddingCache:
+    """molecule encodings keyed by SMILES for one model (identified by `model_hash`).
+
+    Kept in memory; if `cache_dir` is given, encodings are loaded from and saved to
+    `<cache_dir>/<model_hash>_embeddings.npz`"""
+    def __init__(self, model_hash, cache_dir=None):
+        self.model_hash = model_hash
+        self.cache_dir = cache_dir
+        self.embeddings = {}
+        self.changed = False
+        if (self.path is not None and os.path.exists(self.path)):
+            self.load()
+
+    @property
+    def path(self):
+        if (self.cache_dir is None):
+            return None
+        return os.path.join(self.cache_dir, f'{self.model_hash}_embeddings.npz')
+
+    def __contains__(self, smiles):
+        return smiles in self.embeddings
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def get_many(self, smiles):
+        return np.stack([self.embeddings[s] for s in smiles]).astype(np.float32)
+
+    def update(self, items):
+        for s, enc in items:
+            self.embeddings[s] = enc
+            self.changed = True
+
+    def load(self):
+        loaded = np.load(self.path, allow_pickle=False)
+        self.embeddings.update(zip(loaded['smiles'].tolist(), loaded['embeddings']))
+        info(f'loaded {len(loaded["smiles"])} molecule encodings from {self.path}')
+
+    def save(self):
+        if (self.path is None or not self.changed):
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        smiles = list(self.embeddings)
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, smiles=np.array(smiles, dtype=str),
+                 embeddings=np.stack([self.embeddings[s] for s in smiles]))
+        os.replace(tmp_path, self.path)  # no corrupted cache when interrupted
+        self.changed = False
+        info(f'saved {len(smiles)} molecule encodings to {self.path}')
@@ -18,7 +18,7 @@ from collections import Counter
 
 import torch
 
-from utils import REL_COLUMNS, Data, export_predictions
+from utils import REL_COLUMNS, Data, export_predictions, unique_inputs
 from features import features, parse_feature_spec
 
 class NpEncoder(json.JSONEncoder):
@@ -227,6 +227,9 @@ class EvalArgs(Tap):
     model_type: Literal['mpn'] = 'mpn'
     gpu: bool = False
     batch_size: int = 512
+    max_batch_atoms: Optional[int] = None # batch similarly sized molecules up to this number of atoms (at most `batch_size` molecules)
+    graph_workers: int = 1 # number of processes for computing molecular graphs
+    graph_store: Optional[str] = None # directory for persisting molecular graphs between runs
     no_isomeric: bool = False
     repo_root_folder: str = '../RepoRT/' # location of RepoRT, needed for HSM/Tanaka database
     add_desc_file: str = 'data/qm_merged.csv' # csv with additional features with smiles as identifier
@@ -238,7 +241,7 @@ class EvalArgs(Tap):
     remove_void_compounds: bool = False      # remove void compounds completely
     include_void_compounds_mcd: bool = False # don't remove compounds eluting in void volume for minimum compound deletion
     void_factor: float = 2              # factor for 'column.t0' value to use as void threshold
-    cache_file: str = 'cached_descs.pkl'
+    cache_file: str = 'cached_descs.sqlite'
     export_rois: bool = False
     export_rois_dir: Optional[str] = None
     export_embeddings: bool = False
@@ -534,14 +537,9 @@ if __name__ == '__main__':
         data.repo_root_folder = args.repo_root_folder
     info('load cache')
     # load cached descriptors
-    if (args.cache_file is not None):
-        features.write_cache = False # flag for reporting changes to cache
-        info('load cache')
-        if (os.path.exists(args.cache_file)):
-            features.cached = pickle.load(open(args.cache_file, 'rb'))
-        else:
-            features.cached = {}
-            warning('cache file does not exist yet')
+    if (args.cache_file is not None and features_type is not None):
+        from descriptor_cache import DescriptorCache
+        features.cached = DescriptorCache(args.cache_file)
 
     test_stats = []
     data_args = {'use_system_information': data.use_system_information,
@@ -585,6 +583,10 @@ if __name__ == '__main__':
         print(f'only keeping those that conflict for any dataset from train/test data, leaving: {len(confl_pairs)}')
     else:
         confl_pairs = None
+    graph_store = None
+    if (args.graph_store is not None):
+        from graph_store import GraphStore
+        graph_store = GraphStore(args.graph_store)
     dataset_iall = None
     for ds in args.test_sets:
         info(f'loading data for {ds}')
@@ -636,7 +638,7 @@ if __name__ == '__main__':
                            add_desc_file=args.add_desc_file, n_thr=n_thr)
         if (args.model_type != 'ranknet'):
             info('computing graphs')
-            d.compute_graphs()
+            d.compute_graphs(graph_cache=graph_store, n_jobs=args.graph_workers)
         info('(fake) splitting data')
         d.split_data((0, 0))
         if (hasattr(data, 'descriptor_scaler') or hasattr(data, 'sysfeature_scaler')):
@@ -667,6 +669,12 @@ if __name__ == '__main__':
             preds = d.df.roi
         elif (args.model_type == 'mpn'):
             graphs = np.concatenate((train_graphs, test_graphs, val_graphs))
+            # predict only once for each unique (SMILES, features) input
+            smiles_list = d.df.iloc[np.concatenate((d.train_indices, d.test_indices, d.val_indices))]['smiles'].tolist()
+            unique, inverse = unique_inputs(smiles_list, X, X_sys)
+            if (len(unique) < len(smiles_list)):
+                info(f'{len(unique)} unique inputs for {len(smiles_list)} compounds')
+            graphs_u, X_u, X_sys_u = graphs[unique], X[unique], X_sys[unique]
             add_sys_features = hasattr(model, 'add_sys_features') and model.add_sys_features
             include_special_features = (hasattr(model, 'include_special_atom_features')
                                         and model.include_special_atom_features)
@@ -677,7 +685,6 @@ if __name__ == '__main__':
                     info('add system features to graphs')
                 if include_special_features:
                     info('add special atom features to graphs')
-                smiles_list = d.df.iloc[np.concatenate((d.train_indices, d.test_indices, d.val_indices))]['smiles'].tolist()
                 assert len(graphs) == len(smiles_list)
                 assert np.isclose(Y, d.df.iloc[np.concatenate((d.train_indices, d.test_indices, d.val_indices))]['rt'].tolist()).all()
                 from chemprop.features import set_extra_atom_fdim, set_extra_bond_fdim
@@ -686,14 +693,16 @@ if __name__ == '__main__':
                     set_extra_bond_fdim(extra_dim)
                 elif (model.add_sys_features_mode == 'atom'):
                     set_extra_atom_fdim(extra_dim)
-                for i in range(len(graphs)):
-                    graphs[i] = sysfeature_graph(smiles_list[i], graphs[i],
-                                                 X_sys[i] if add_sys_features else None,
-                                                 bond_or_atom=model.add_sys_features_mode,
-                                                 special_features=include_special_features)
+                for i, j in enumerate(unique):
+                    graphs_u[i] = sysfeature_graph(smiles_list[j], graphs_u[i],
+                                                   X_sys_u[i] if add_sys_features else None,
+                                                   bond_or_atom=model.add_sys_features_mode,
+                                                   special_features=include_special_features)
             if (not args.model_type == 'rankformer' and args.export_embeddings):
-                preds, embeddings = model.predict(graphs, X, X_sys, batch_size=args.batch_size,
-                                                  prog_bar=args.verbose, ret_features=True)
+                preds, embeddings = model.predict(graphs_u, X_u, X_sys_u, batch_size=args.batch_size,
+                                                  prog_bar=args.verbose, ret_features=True,
+                                                  graph_store=graph_store, max_batch_atoms=args.max_batch_atoms)
+                preds, embeddings = preds[inverse], embeddings[inverse]
                 embeddings_df = pd.DataFrame({'smiles': d.df.smiles} |
                                              {f'e{i}': embeddings[:, i]
                                               for i in range(embeddings.shape[1])})
@@ -701,8 +710,9 @@ if __name__ == '__main__':
                 embeddings_df.to_csv(f'runs/{config["name"]}_{ds_id}_embeddings.tsv',
                                      sep='\t')
             else:
-                preds = model.predict(graphs, X, X_sys, batch_size=args.batch_size,
-                                      **(dict(ret_features=False, prog_bar=args.verbose) if not args.model_type == 'rankformer' else {}))
+                preds = model.predict(graphs_u, X_u, X_sys_u, batch_size=args.batch_size,
+                                      **(dict(ret_features=False, prog_bar=args.verbose, graph_store=graph_store,
+                                             max_batch_atoms=args.max_batch_atoms) if not args.model_type == 'rankformer' else {}))[inverse]
         else:
             preds = predict(X, model, args.batch_size)
         info('done predicting. evaluation...')
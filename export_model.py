@@ -0,0 +1,223 @@
+"""exports a (repackaged) MPNranker as TorchScript or ONNX graph operating on plain tensors, for lean CPU inference:
+
+    python export_model.py --model models/twostep_everything_predready.pt --out models/twostep_everything.onnx
+
+Inputs of the exported graph are the tensors of a `BatchMolGraph` (f_atoms, f_bonds, a2b, b2a, b2revb, a_scope)
+plus extra and system features, output are the ROIs. Everything else needed for prediction (`extra_storage`) is
+stored next to it in `<out>.meta.pkl`. The exported file can be used with `predict.py --model` like the full model.
+"""
+from logging import basicConfig, INFO, info, warning
+from tap import Tap
+from typing import Literal, Optional
+import hashlib
+import pickle
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+INPUT_NAMES = ['f_atoms', 'f_bonds', 'a2b', 'b2a', 'b2revb', 'a_scope', 'extra', 'sysf']
+
+class ExportArgs(Tap):
+    model: str                   # model to export (output of `repackage_model.py`)
+    out: str                     # output file (.ts or .onnx)
+    format: Optional[Literal['torchscript', 'onnx']] = None # default: from the file extension of `out`
+    opset: int = 17              # ONNX opset version
+    no_check: bool = False       # don't compare predictions of the exported and the original model
+
+class TensorRanker(nn.Module):
+    """MPNranker (D-MPNN encoder + ranking layers) on plain tensors; model options are fixed on construction"""
+    def __init__(self, model):
+        super(TensorRanker, self).__init__()
+        mpn = model.encoder.encoder[0]
+        if (mpn.atom_messages or mpn.is_atom_bond_targets or mpn.aggregation not in ['mean', 'sum', 'norm']
+            or model.encoder.use_input_features or model.encoder.features_only):
+            raise NotImplementedError('only bond message passing encoders without additional features can be exported')
+        self.W_i, self.W_h, self.W_o = mpn.W_i, mpn.W_h, mpn.W_o
+        self.depth = mpn.depth
+        self.undirected = mpn.undirected
+        self.aggregation = mpn.aggregation
+        self.aggregation_norm = mpn.aggregation_norm
+        self.hidden_size = mpn.hidden_size
+        # ranking layers, see `MPNranker.head`
+        self.no_sys_layers = hasattr(model, 'no_sys_layers') and model.no_sys_layers
+        self.sys_blowup = hasattr(model, 'sys_blowup') and model.sys_blowup
+        self.res_conn_enc = not hasattr(model, 'res_conn_enc') or model.res_conn_enc
+        if (self.sys_blowup):
+            self.sys_blowup_layer = model.sys_blowup_layer
+        if (not self.no_sys_layers):
+            self.hidden_pv = model.hidden_pv
+        self.hidden = model.hidden
+        self.ident = model.ident
+
+    def encode(self, f_atoms, f_bonds, a2b, b2a, b2revb, a_scope):
+        """same computations as chemprop's `MPNEncoder.forward` (in eval mode)"""
+        inp = self.W_i(f_bonds)
+        message = F.relu(inp)
+        for _ in range(self.depth - 1):
+            if (self.undirected):
+                message = (message + message[b2revb]) / 2
+            nei_a_message = message.index_select(0, a2b.view(-1)).view(a2b.size(0), a2b.size(1), -1)
+            a_message = nei_a_message.sum(dim=1)
+            message = a_message[b2a] - message[b2revb]
+            message = F.relu(inp + self.W_h(message))
+        nei_a_message = message.index_select(0, a2b.view(-1)).view(a2b.size(0), a2b.size(1), -1)
+        a_message = nei_a_message.sum(dim=1)
+        atom_hiddens = F.relu(self.W_o(torch.cat([f_atoms, a_message], dim=1)))
+        # readout: atoms of the molecules follow each other, starting after the padding atom 0
+        sizes = a_scope[:, 1]
+        mol_index = torch.repeat_interleave(torch.arange(a_scope.size(0)), sizes)
+        mol_vecs = torch.zeros(a_scope.size(0), self.hidden_size).scatter_add(
+            0, mol_index.unsqueeze(1).expand(-1, self.hidden_size), atom_hiddens[1:])
+        if (self.aggregation == 'mean'):
+            mol_vecs = mol_vecs / sizes.clamp(min=1).unsqueeze(1).to(mol_vecs.dtype)
+        elif (self.aggregation == 'norm'):
+            mol_vecs = mol_vecs / self.aggregation_norm
+        return mol_vecs
+
+    def forward(self, f_atoms, f_bonds, a2b, b2a, b2revb, a_scope, extra, sysf):
+        enc = self.encode(f_atoms, f_bonds, a2b, b2a, b2revb, a_scope)
+        if (not self.no_sys_layers):
+            if (self.sys_blowup):
+                sysf = F.relu(self.sys_blowup_layer(sysf))
+            enc_pv = torch.cat([enc, extra, sysf], 1)
+            for h in self.hidden_pv:
+                enc_pv = F.relu(h(enc_pv))
+            if (self.res_conn_enc):
+                enc = torch.cat([enc, extra, enc_pv], 1)
+            else:
+                enc = torch.cat([extra, enc_pv], 1)
+        else:
+            enc = torch.cat([extra, enc], 1)
+        for h in self.hidden:
+            enc = F.relu(h(enc))
+        return torch.sigmoid(self.ident(enc).transpose(0, 1)[0])
+
+def batch_inputs(graphs, extra, sysf):
+    """inputs of the exported model for a list of graphs"""
+    from dmpnn_graph import dmpnn_batch, dense_batch
+    f_atoms, f_bonds, a2b, b2a, b2revb, a_scope, _ = dmpnn_batch(graphs).get_components(atom_messages=False)
+    return (f_atoms, f_bonds, a2b, b2a, b2revb, torch.tensor(a_scope, dtype=torch.long).reshape(-1, 2),
+            torch.as_tensor(dense_batch(extra).astype(np.float32)).reshape(len(graphs), -1),
+            torch.as_tensor(dense_batch(sysf).astype(np.float32)).reshape(len(graphs), -1))
+
+def model_graphs(model, smiles, graphs, sysf):
+    """`graphs` with the system (and special atom) features attached if `model` was trained with them
+    (as in `predict.predict_rois`)"""
+    add_sys_features = hasattr(model, 'add_sys_features') and model.add_sys_features
+    include_special_features = hasattr(model, 'include_special_atom_features') and model.include_special_atom_features
+    if (not (add_sys_features or include_special_features)):
+        return graphs
+    from chemprop.features import set_extra_atom_fdim, set_extra_bond_fdim
+    from utils_newbg import sysfeature_graph, SPECIAL_FEATURES_SIZE
+    extra_dim = (model.sys_features_dim if add_sys_features else 0) + (SPECIAL_FEATURES_SIZE if include_special_features else 0)
+    if (model.add_sys_features_mode == 'bond'):
+        set_extra_bond_fdim(extra_dim)
+    elif (model.add_sys_features_mode == 'atom'):
+        set_extra_atom_fdim(extra_dim)
+    return [sysfeature_graph(s, graph, sysf[i] if add_sys_features else None, bond_or_atom=model.add_sys_features_mode,
+                             special_features=include_special_features)
+            for i, (s, graph) in enumerate(zip(smiles, graphs))]
+
+def export(model, out, format='torchscript', example_graphs=None, example_extra=None, example_sysf=None,
+           opset=17):
+    """exports `model` to `out` (+ `<out>.meta.pkl`); example inputs are used for tracing
+    (`example_graphs` have to carry the system features already if the model uses them, see `model_graphs`)"""
+    model.eval()
+    tensor_model = TensorRanker(model).eval()
+    if (example_sysf is None):
+        example_sysf = np.zeros((len(example_graphs) if example_graphs is not None else 3, model.sys_features_dim),
+                                dtype=np.float32)
+    if (example_graphs is None):
+        from dmpnn_graph import dmpnn_graph
+        smiles = ['CCCN', 'c1ccccc1O', 'OCC(O)CO']
+        example_graphs = model_graphs(model, smiles, [dmpnn_graph(s) for s in smiles], example_sysf)
+    if (example_extra is None):
+        example_extra = np.zeros((len(example_graphs), model.extra_features_dim), dtype=np.float32)
+    inputs = batch_inputs(example_graphs, example_extra, example_sysf)
+    with torch.no_grad():
+        if (format == 'torchscript'):
+            torch.jit.trace(tensor_model, inputs, check_trace=False).save(out)
+        elif (format == 'onnx'):
+            dynamic_axes = {'f_atoms': [0], 'f_bonds': [0], 'a2b': [0, 1], 'b2a': [0], 'b2revb': [0],
+                            'a_scope': [0], 'extra': [0], 'sysf': [0], 'roi': [0]}
+            export_args = dict(input_names=INPUT_NAMES, output_names=['roi'], dynamic_axes=dynamic_axes,
+                               opset_version=opset)
+            try:
+                torch.onnx.export(tensor_model, inputs, out, dynamo=False, **export_args)
+            except TypeError:   # older torch versions without the `dynamo` exporter
+                torch.onnx.export(tensor_model, inputs, out, **export_args)
+        else:
+            raise NotImplementedError(format)
+    meta = {'format': format,
+            'extra_storage': model.extra_storage if hasattr(model, 'extra_storage') else None,
+            'add_sys_features': hasattr(model, 'add_sys_features') and model.add_sys_features,
+            'add_sys_features_mode': model.add_sys_features_mode if hasattr(model, 'add_sys_features_mode') else None}
+    pickle.dump(meta, open(out + '.meta.pkl', 'wb'))
+    info(f'exported model to {out} ({format})')
+
+class ExportedRanker:
+    """exported model with the `predict` interface of `MPNranker`"""
+    def __init__(self, path, threads=None):
+        meta = pickle.load(open(path + '.meta.pkl', 'rb'))
+        self.format = meta['format']
+        self.extra_storage = meta['extra_storage']
+        self.add_sys_features = meta['add_sys_features']
+        self.add_sys_features_mode = meta['add_sys_features_mode']
+        self.file_hash = hashlib.sha1(open(path, 'rb').read()).hexdigest()
+        if (self.format == 'torchscript'):
+            if (threads is not None):
+                torch.set_num_threads(threads)
+            self.module = torch.jit.load(path, map_location='cpu')
+        elif (self.format == 'onnx'):
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if (threads is not None):
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        else:
+            raise NotImplementedError(self.format)
+
+    def state_dict(self):
+        # identifies the model, e.g., for `embedding_cache.model_hash`
+        return {'exported_model': self.file_hash}
+
+    def run(self, inputs):
+        if (self.format == 'torchscript'):
+            with torch.no_grad():
+                return self.module(*inputs).numpy()
+        return self.session.run(None, {name: x.numpy() for name, x in zip(INPUT_NAMES, inputs)})[0]
+
+    def predict(self, graphs, extra, sysf, batch_size=8192, prog_bar=False, ret_features=False,
+                embedding_cache=None, max_batch_atoms=None, **kwargs):
+        from dmpnn_graph import batch_indices, take_batch, restore_order
+        if (ret_features):
+            raise NotImplementedError('exported models only return ROIs')
+        if (embedding_cache is not None):
+            warning('exported models don\'t support the embedding cache, not using it')
+        batches = batch_indices(graphs, batch_size, max_batch_atoms)
+        it = batches
+        if (prog_bar):
+            from tqdm import tqdm
+            it = tqdm(it)
+        preds = []
+        for idx in it:
+            preds.append(self.run(batch_inputs(take_batch(graphs, idx), take_batch(extra, idx),
+                                               take_batch(sysf, idx))))
+        return restore_order(preds, batches)
+
+if __name__ == '__main__':
+    args = ExportArgs().parse_args()
+    basicConfig(level=INFO)
+    from predict import load_model
+    format = args.format or ('onnx' if args.out.endswith('.onnx') else 'torchscript')
+    model = load_model(args.model, all_in_one=True)
+    export(model, args.out, format=format, opset=args.opset)
+    if (not args.no_check):
+        from dmpnn_graph import dmpnn_graph
+        smiles = ['CCCN', 'C([C@@H]1[C@H]([C@@H]([C@H](C(O1)O)O)O)O)O', 'c1ccc2ccccc2c1', 'CC(=O)Oc1ccccc1C(=O)O', '[Na+]']
+        extra = np.zeros((len(smiles), model.extra_features_dim), dtype=np.float32)
+        sysf = np.random.default_rng(0).normal(size=(len(smiles), model.sys_features_dim)).astype(np.float32)
+        graphs = model_graphs(model, smiles, [dmpnn_graph(s) for s in smiles], sysf)
+        diff = np.abs(model.predict(graphs, extra, sysf) - ExportedRanker(args.out).predict(graphs, extra, sysf)).max()
+        print(f'max. difference to the original model: {diff:.2e}')
@@ -1,32 +1,186 @@
 import numpy as np
-from rdkit import Chem
-from rdkit.Chem import AllChem, Descriptors, Descriptors3D
 import multiprocessing as mp
+import atexit
 import logging
 
 logger = logging.getLogger('twosteprt.features')
 info = logger.info
 warning = logger.warning
 
+# NOTE: RDKit descriptor modules are imported where needed, they are slow to import and not needed for inference
+
+# increase when the values of a descriptor family change (e.g., how molecules are prepared), invalidates cached values
+DESCRIPTOR_VERSIONS = {'rdk': 1, '3d': 2}
+
+# conformers for 3D descriptors: seeded ETKDG with a bounded number of attempts
+EMBED_SEED = 42
+EMBED_MAX_ITERATIONS = 200
+EMBED_TIMEOUT = 10              # seconds (RDKit versions supporting it)
+
+def descriptor_version(name):
+    """identifies the computed values of the descriptor `name`, e.g., for `descriptor_cache.DescriptorCache`"""
+    import rdkit
+    kind = descriptor_kinds().get(name, 'rdk')
+    return f'rdkit{rdkit.__version__}_{kind}{DESCRIPTOR_VERSIONS[kind]}'
+
+def legacy_descriptor_version(name):
+    """version of values computed before `DESCRIPTOR_VERSIONS` existed (e.g., pickled caches): the first version
+    of each family, i.e., 3D descriptors from conformers without seeded ETKDG are not used as current values"""
+    import rdkit
+    kind = descriptor_kinds().get(name, 'rdk')
+    return f'rdkit{rdkit.__version__}_{kind}1'
+
+def embed_molecule(mol):
+    """adds a conformer to `mol` (with hydrogens); returns whether embedding succeeded"""
+    from rdkit.Chem import AllChem
+    params = AllChem.ETKDGv3()
+    params.randomSeed = EMBED_SEED
+    params.maxIterations = EMBED_MAX_ITERATIONS
+    if (hasattr(params, 'timeout')):
+        params.timeout = EMBED_TIMEOUT
+    return AllChem.EmbedMolecule(mol, params) == 0
+
+_registry = None
+_kinds = None
+
+def descriptor_registry():
+    """name -> descriptor function for all descriptors of `get_descriptors` (built once per process)"""
+    global _registry
+    if (_registry is None):
+        _registry = {name: fun for name, fun, _ in get_descriptors()}
+    return _registry
+
+def descriptor_kinds():
+    """name -> descriptor family (`rdk` or `3d`)"""
+    global _kinds
+    if (_kinds is None):
+        _kinds = {name: kind for name, _, kind in get_descriptors()}
+    return _kinds
+
 def compute_descriptors(smile, descriptors):
+    from rdkit import Chem
+    registry = descriptor_registry()
+    kinds = descriptor_kinds()
     try:
         mol = Chem.AddHs(Chem.MolFromSmiles(smile))
-        AllChem.EmbedMolecule(mol)
-    except:
+        # conformers are only needed for 3D descriptors (2D descriptors don't change with them)
+        embedded = any(kinds[name] == '3d' for name in descriptors) and embed_molecule(mol)
+    except Exception:
         return [descriptors, [np.nan for _ in descriptors], descriptors]
     values = []
     failed = []
     for name in descriptors:
-        fun = features.descriptors[name]
+        fun = registry[name]
+        if (kinds[name] == '3d' and not embedded):
+            values.append(np.nan)
+            failed.append(name)
+            continue
         try:
             val = fun(mol)
-        except:
+        except Exception:
             val = np.nan
             failed.append(name)
         values.append(val)
     return [descriptors, values, failed]
 
+class MoleculeTimeout(BaseException):
+    # not an `Exception`, so that it isn't caught as failed descriptor computation
+    pass
+
+def _raise_timeout(signum, frame):
+    raise MoleculeTimeout()
+
+def _init_worker():
+    import signal
+    descriptor_registry()       # import RDKit and look up the descriptors once per worker
+    if (hasattr(signal, 'SIGALRM')):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+
+def _compute_chunk(smiles, descriptors, timeout=None):
+    """`compute_descriptors` for several molecules (sharing the list of descriptors); molecules taking longer
+    than `timeout` seconds get NaN for all descriptors (a running RDKit function is finished first)"""
+    import signal
+    use_alarm = timeout is not None and hasattr(signal, 'SIGALRM')
+    results = []
+    for smile in smiles:
+        # the timer is cleared inside the protected region: an alarm arriving late (after the descriptors were
+        # computed, but before the timer was cleared) only gives NaN values for this molecule
+        try:
+            try:
+                if (use_alarm):
+                    signal.setitimer(signal.ITIMER_REAL, timeout)
+                result = compute_descriptors(smile, descriptors)
+            finally:
+                if (use_alarm):
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except MoleculeTimeout:
+            result = [descriptors, [np.nan for _ in descriptors], descriptors]
+        results.append(result)
+    return results
+
+class DescriptorEngine:
+    """long-lived pool of `n_jobs` processes computing RDKit descriptors.
+
+    Workers look up the descriptor functions themselves; molecules are sent in chunks of `chunk_size`
+    (default: about 4 chunks per worker, at most 64 molecules) together with the names of the descriptors
+    to compute, results are streamed back in order. With `timeout` (seconds, Unix only), molecules taking
+    longer get NaN values. With `n_jobs=1` (or a single molecule), descriptors are computed in this process,
+    unless `timeout` is given: it can only be applied in a worker process, so a pool of one process is used then."""
+    def __init__(self, n_jobs=1, chunk_size=None, timeout=None):
+        self.n_jobs = max(1, n_jobs)
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.pool = None
+
+    def _get_pool(self):
+        if (self.pool is None):
+            self.pool = mp.Pool(self.n_jobs, initializer=_init_worker)
+        return self.pool
+
+    def compute(self, to_calc):
+        """yields (descriptors, values, failed) like `compute_descriptors` for each (SMILES, descriptors) of `to_calc`"""
+        to_calc = list(to_calc)
+        if ((self.n_jobs == 1 or len(to_calc) == 1) and self.timeout is None):
+            for smile, descriptors in to_calc:
+                yield compute_descriptors(smile, descriptors)
+            return
+        chunk_size = self.chunk_size or int(min(64, max(1, np.ceil(len(to_calc) / (self.n_jobs * 4)))))
+        # molecules needing the same descriptors (usually all) are chunked together
+        tasks = []
+        for i in range(0, len(to_calc), chunk_size):
+            chunk = to_calc[i:i + chunk_size]
+            start = 0
+            for j in range(1, len(chunk) + 1):
+                if (j == len(chunk) or chunk[j][1] != chunk[start][1]):
+                    tasks.append(([smile for smile, _ in chunk[start:j]], chunk[start][1], self.timeout))
+                    start = j
+        for results in self._get_pool().imap(_compute_chunk_task, tasks):
+            yield from results
+
+    def close(self):
+        if (self.pool is not None):
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def _compute_chunk_task(task):
+    return _compute_chunk(*task)
+
+_engines = {}
+
+def descriptor_engine(n_jobs, timeout=None):
+    """shared `DescriptorEngine` (kept alive between `features` calls)"""
+    if ((n_jobs, timeout) not in _engines):
+        _engines[(n_jobs, timeout)] = DescriptorEngine(n_jobs, timeout=timeout)
+    return _engines[(n_jobs, timeout)]
+
+@atexit.register
+def _close_engines():
+    for engine in _engines.values():
+        engine.close()
+
 def get_descriptors():
+    from rdkit.Chem import Descriptors, Descriptors3D
     features = []
     features.extend([(name, fun, 'rdk') for name, fun in Descriptors.descList])
     features.extend([(name, fun, '3d') for name, fun in
@@ -39,17 +193,16 @@ def get_descriptors():
                       ('SpherocityIndex', Descriptors3D.SpherocityIndex)]])
     return features
 
-def compute_morgan(smile, bits=1024, radius=2):
-    mol = Chem.AddHs(Chem.MolFromSmiles(smile))
-    AllChem.EmbedMolecule(mol)
-    return np.array(AllChem.GetMorganFingerprintAsBitVect(mol, radius, nBits=bits))
-
 def features(smiles, filter_='rdk', overwrite_cache=False, verbose=False,
              custom_features=[], mode='rdkit', load_factor=0.75,
-             add_descs=False, add_desc_file='data/qm_merged.csv'):
+             add_descs=False, add_desc_file='data/qm_merged.csv', engine=None, timeout=None, sparse=False):
     """computes and returns features as well as an ordered list of descriptors.
 
-    If `custom_features` ~= ["morgan\\d"], use morgan fingerprints, ignoring `filter_`
+    If `custom_features` ~= ["morgan\\d"], use morgan fingerprints, ignoring `filter_`.
+    `mode='morgan<bits>'` gives Morgan fingerprints (radius 2) with `bits` bits (default 1024);
+    with `sparse`, features are returned as scipy CSR matrix.
+    RDKit descriptors are computed by `engine` (default: a shared `DescriptorEngine` using `load_factor` of the CPUs,
+    molecules taking longer than `timeout` seconds get NaN values)
     """
     assert (len(smiles) == len(set(smiles))), 'smiles have to be unique'
     if (not hasattr(features, 'cached')):
@@ -59,9 +212,11 @@ def features(smiles, filter_='rdk', overwrite_cache=False, verbose=False,
     if (mode is None):
         mode = ''
     if (mode.startswith('morgan')):
-        bits = 1024
+        from fingerprints import morgan_fingerprints
+        bits = int(mode[len('morgan'):]) if len(mode) > len('morgan') else 1024
         radius = 2
-        out_arrays.append(np.concatenate([compute_morgan(smile, bits, radius) for smile in smiles]))
+        fps = morgan_fingerprints(smiles, bits, radius)
+        out_arrays.append(fps.to_csr(np.float64) if sparse else fps.to_dense(np.float64))
         out_names.extend([f'morgan{i}' for i in range(bits)])
     if (mode.startswith('ae')):
         s1, s2 = list(map(int, mode[2:]))
@@ -81,30 +236,37 @@ def features(smiles, filter_='rdk', overwrite_cache=False, verbose=False,
             descriptors = sorted(list(filter(lambda t: t[0] in custom_features, descriptors)),
                               key=lambda t: custom_features.index(t[0]))
         features.descriptors = {name: fun for name, fun, _ in descriptors}
+        # persistent caches (`DescriptorCache`) are only queried for the SMILES needed
+        cached = (features.cached.get_many(smiles, features.descriptors) if hasattr(features.cached, 'get_many')
+                  else features.cached)
         to_calc = {}
         for s in smiles:
             for fname, ffun, _ in descriptors:
-                if ((s, fname) not in features.cached
+                if ((s, fname) not in cached
                     or overwrite_cache):
                     to_calc.setdefault(s, []).append(fname)
         to_calc = [(smile, descriptors) for smile, descriptors in to_calc.items()]
         if (len(to_calc) > 0):
-            if (hasattr(features, 'write_cache')):
-                features.write_cache = True # cache has to be written in the end
-            nthreads = np.floor(mp.cpu_count() * load_factor).astype(int)
+            if (engine is None):
+                engine = descriptor_engine(max(1, int(np.floor(mp.cpu_count() * load_factor))), timeout=timeout)
             if (verbose):
-                info(f'calculating {len(to_calc)} feature values using {nthreads} threads')
-            pool = mp.Pool(nthreads)
-            res = pool.starmap(compute_descriptors, to_calc)
-            pool.close()
-            res_new = []
-            for descs, values, failed in res:
+                info(f'calculating {len(to_calc)} feature values using {engine.n_jobs} processes')
+            # new values are written to the cache while computing (an interrupted run keeps what was computed)
+            flush_size = getattr(features.cached, 'batch_size', 10_000)
+            new_values = {}
+            for (smile, _), (descs, values, failed) in zip(to_calc, engine.compute(to_calc)):
                 if (len(failed) > 0 and verbose):
                     info('failed', failed)
-                res_new.append([(d, v) for d, v in zip(descs, values)])
-            features.cached.update({(smile[0], desc): value for smile, smile_res in zip(to_calc, res_new)
-                                    for desc, value in smile_res})
-        out_arrays.append(np.array([[features.cached[(smile, desc[0])] for desc in descriptors]
+                new_values.update({(smile, desc): value for desc, value in zip(descs, values)})
+                if (len(new_values) >= flush_size):
+                    features.cached.update(new_values)
+                    if (cached is not features.cached):
+                        cached.update(new_values)
+                    new_values = {}
+            features.cached.update(new_values)
+            if (cached is not features.cached):
+                cached.update(new_values)
+        out_arrays.append(np.array([[cached[(smile, desc[0])] for desc in descriptors]
                                     for smile in smiles]))
         out_names.extend([desc[0] for desc in descriptors])
         # return np.array([[features.cached[(smile, desc[0])] for desc in descriptors]
@@ -113,7 +275,10 @@ def features(smiles, filter_='rdk', overwrite_cache=False, verbose=False,
         out, names = get_add_descs(smiles, add_desc_file=add_desc_file)
         out_arrays.append(out)
         out_names.extend(names)
-    if (len(out_arrays) > 0):
+    if (sparse):
+        from scipy.sparse import csr_matrix, hstack
+        out = hstack([csr_matrix(a) for a in out_arrays] or [csr_matrix((len(smiles), 0))], format='csr')
+    elif (len(out_arrays) > 0):
         out = np.concatenate(out_arrays, axis=1)
     else:
         out = np.array([]).reshape((len(smiles), 0))
@@ -0,0 +1,96 @@
+"""molecular fingerprints for many molecules, stored bit-packed (`uint8`, 8 bits per byte):
+
+    fps = morgan_fingerprints(smiles, n_bits=2048, radius=2)
+    fps.fold(1024).to_csr()     # scipy.sparse CSR matrix (float32), e.g., as extra features for `MPNranker.predict`
+
+Fingerprints are generated with RDKit's fingerprint generators in batches. Packed storage needs one bit per
+feature (64x less than dense float64), `to_dense` and `to_csr` convert (chunk-wise) for consumers.
+"""
+import logging
+import numpy as np
+
+logger = logging.getLogger('twosteprt.fingerprints')
+info = logger.info
+warning = logger.warning
+
+class PackedFingerprints:
+    """bit fingerprints of `len(packed)` molecules with `n_bits` bits each, packed into `uint8` rows"""
+    def __init__(self, packed, n_bits):
+        self.packed = np.asarray(packed, dtype=np.uint8)
+        self.n_bits = n_bits
+        assert self.packed.ndim == 2 and self.packed.shape[1] == (n_bits + 7) // 8, 'wrong shape of packed fingerprints'
+
+    @classmethod
+    def from_on_bits(cls, on_bits, n_bits, chunk_size=10_000):
+        """from lists of set bits (one per molecule)"""
+        packed = np.zeros((len(on_bits), (n_bits + 7) // 8), dtype=np.uint8)
+        for start in range(0, len(on_bits), chunk_size):
+            chunk = on_bits[start:start + chunk_size]
+            dense = np.zeros((len(chunk), n_bits), dtype=np.uint8)
+            rows = np.repeat(np.arange(len(chunk)), [len(bits) for bits in chunk])
+            dense[rows, np.fromiter((b for bits in chunk for b in bits), dtype=np.int64, count=len(rows))] = 1
+            packed[start:start + len(chunk)] = np.packbits(dense, axis=1)
+        return cls(packed, n_bits)
+
+    @property
+    def shape(self):
+        return (len(self.packed), self.n_bits)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, idx):
+        """fingerprints of the molecules `idx` (slice, index array or boolean mask)"""
+        return PackedFingerprints(self.packed[idx].reshape(-1, self.packed.shape[1]), self.n_bits)
+
+    def fold(self, n_bits):
+        """folded to `n_bits` (a divisor of the current size): bit i is set if any bit j with j % n_bits == i is"""
+        if (n_bits == self.n_bits):
+            return self
+        if (self.n_bits % n_bits != 0):
+            raise ValueError(f'can\'t fold {self.n_bits} bits to {n_bits}')
+        if (n_bits % 8 == 0):
+            folded = np.bitwise_or.reduce(self.packed.reshape(len(self), self.n_bits // n_bits, n_bits // 8), axis=1)
+            return PackedFingerprints(folded, n_bits)
+        dense = np.unpackbits(self.packed, axis=1, count=self.n_bits)
+        return PackedFingerprints(np.packbits(dense.reshape(len(self), -1, n_bits).any(axis=1), axis=1), n_bits)
+
+    def to_dense(self, dtype=np.float32):
+        return np.unpackbits(self.packed, axis=1, count=self.n_bits).astype(dtype)
+
+    def to_csr(self, dtype=np.float32, chunk_size=10_000):
+        from scipy.sparse import csr_matrix
+        indptr = [np.zeros(1, dtype=np.int64)]
+        indices = []
+        for start in range(0, len(self), chunk_size):
+            dense = np.unpackbits(self.packed[start:start + chunk_size], axis=1, count=self.n_bits)
+            rows, cols = np.nonzero(dense)
+            indices.append(cols)
+            indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(rows, minlength=len(dense))))
+        indices = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=np.int64)
+        return csr_matrix((np.ones(len(indices), dtype=dtype), indices, np.concatenate(indptr)), shape=self.shape)
+
+    def save(self, path):
+        np.savez(path, packed=self.packed, n_bits=self.n_bits)
+
+    @classmethod
+    def load(cls, path):
+        loaded = np.load(path)
+        return cls(loaded['packed'], int(loaded['n_bits']))
+
+def morgan_fingerprints(smiles, n_bits=1024, radius=2, n_jobs=1, chunk_size=10_000):
+    """Morgan (ECFP-like) bit fingerprints of `smiles`; invalid SMILES get empty fingerprints"""
+    from rdkit import Chem
+    from rdkit.Chem import rdFingerprintGenerator
+    generator = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=n_bits)
+    on_bits = []
+    n_invalid = 0
+    for start in range(0, len(smiles), chunk_size):
+        mols = [Chem.MolFromSmiles(s) for s in smiles[start:start + chunk_size]]
+        valid = [m for m in mols if m is not None]
+        n_invalid += len(mols) - len(valid)
+        fps = iter(generator.GetFingerprints(valid, numThreads=n_jobs))
+        on_bits.extend([tuple(next(fps).GetOnBits()) if m is not None else () for m in mols])
+    if (n_invalid > 0):
+        warning(f'{n_invalid} SMILES could not be parsed, their fingerprints are empty')
+    return PackedFingerprints.from_on_bits(on_bits, n_bits)
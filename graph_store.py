@@ -0,0 +1,125 @@
+"""persistent store for molecular graphs, so that molecules seen before don't have to be featurized again.
+
+Graphs are stored in append-only segments of memory-mapped numpy arrays (all atom/bond features of a
+segment in one array + offsets index), one directory per featurizer version
+(chemprop version and atom/bond feature dimensions)."""
+import json
+import os
+import time
+import logging
+import numpy as np
+
+from dmpnn_graph import dmpnn_graph, dmpnn_graphs, graph_to_arrays, graph_from_arrays
+
+logger = logging.getLogger('twosteprt.graph_store')
+info = logger.info
+warning = logger.warning
+
+ARRAY_ATTRIBUTES = ('f_atoms', 'f_bonds', 'b2a', 'b2revb', 'b2br', 'n_atoms', 'n_bonds', 'a2b')
+
+class GraphStore:
+    """dict-like (SMILES -> graph) store in `<root>/<featurizer key>/`; can be used as `graph_cache` for
+    `Data.compute_graphs`. Only plain graphs (without extra atom/bond features) can be stored."""
+    def __init__(self, root):
+        import chemprop
+        self.root = root
+        # identifies the graphs computed by `dmpnn_graph` with the installed chemprop
+        probe = dmpnn_graph('CC')
+        self.atom_fdim, self.bond_fdim = len(probe.f_atoms[0]), len(probe.f_bonds[0])
+        self.key = f'chemprop{chemprop.__version__}_a{self.atom_fdim}_b{self.bond_fdim}'
+        self.path = os.path.join(root, self.key)
+        self.segments = {}      # name -> arrays
+        self.index = {}         # SMILES -> (segment name, position)
+        self.attributes = None  # attributes shared by all graphs (is_mol, reaction_mode, ...)
+        self.reload()
+
+    def reload(self):
+        """indexes segments written (e.g., by other processes) since the last load"""
+        if (not os.path.isdir(self.path)):
+            return
+        if (self.attributes is None and os.path.exists(os.path.join(self.path, 'attributes.json'))):
+            self.attributes = json.load(open(os.path.join(self.path, 'attributes.json')))
+        for name in sorted(os.listdir(self.path)):
+            if (not name.startswith('seg_') or name in self.segments):
+                continue
+            seg_path = os.path.join(self.path, name)
+            segment = {k: np.load(os.path.join(seg_path, f'{k}.npy'), mmap_mode='r')
+                       for k in ['atoms', 'bonds', 'b2a', 'b2revb', 'b2br', 'offsets']}
+            self.segments[name] = segment
+            for i, s in enumerate(json.load(open(os.path.join(seg_path, 'smiles.json')))):
+                self.index.setdefault(s, (name, i))
+        info(f'{len(self.index)} graphs in store {self.path} ({len(self.segments)} segments)')
+
+    def __contains__(self, smiles):
+        return smiles in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, smiles):
+        name, i = self.index[smiles]
+        segment = self.segments[name]
+        (a_start, b_start), (a_end, b_end) = segment['offsets'][i], segment['offsets'][i + 1]
+        arrays = dict(self.attributes)
+        arrays.update(n_atoms=int(a_end - a_start), n_bonds=int(b_end - b_start),
+                      f_atoms=segment['atoms'][a_start:a_end], f_bonds=segment['bonds'][b_start:b_end],
+                      b2a=segment['b2a'][b_start:b_end], b2revb=segment['b2revb'][b_start:b_end],
+                      b2br=segment['b2br'][b_start // 2:b_end // 2].astype(float))
+        return graph_from_arrays(arrays)
+
+    def get(self, smiles, default=None):
+        return self[smiles] if smiles in self else default
+
+    def keys(self):
+        return self.index.keys()
+
+    def update(self, graphs):
+        """adds (SMILES -> graph) mapping or pairs as a new segment; SMILES already in the store are skipped"""
+        items = graphs.items() if hasattr(graphs, 'items') else graphs
+        new = {}
+        for s, graph in items:
+            if (s not in self.index and s not in new):
+                new[s] = graph_to_arrays(graph)
+        if (len(new) == 0):
+            return
+        self._write_segment(new)
+
+    def add_smiles(self, smiles, n_jobs=1):
+        """computes and stores graphs for all SMILES not yet in the store"""
+        smiles_new = list(dict.fromkeys(s for s in smiles if s not in self.index))
+        if (len(smiles_new) > 0):
+            info(f'computing {len(smiles_new)} graphs for the graph store')
+            self.update(zip(smiles_new, dmpnn_graphs(smiles_new, n_jobs=n_jobs)))
+
+    def _write_segment(self, new):
+        attributes = {k: v for k, v in next(iter(new.values())).items() if k not in ARRAY_ATTRIBUTES}
+        if (self.attributes is None):
+            self.attributes = attributes
+        for s, arrays in new.items():
+            if ({k: v for k, v in arrays.items() if k not in ARRAY_ATTRIBUTES} != self.attributes):
+                raise ValueError(f'graph for {s} was featurized differently from the graphs in the store')
+            if ((arrays['n_atoms'] > 0 and arrays['f_atoms'].shape[1] != self.atom_fdim)
+                or (arrays['n_bonds'] > 0 and arrays['f_bonds'].shape[1] != self.bond_fdim)):
+                raise ValueError(f'graph for {s} has extra atom/bond features, can\'t be stored')
+        os.makedirs(self.path, exist_ok=True)
+        if (not os.path.exists(os.path.join(self.path, 'attributes.json'))):
+            json.dump(self.attributes, open(os.path.join(self.path, 'attributes.json'), 'w'))
+        offsets = np.zeros((len(new) + 1, 2), dtype=np.int64)
+        offsets[1:, 0] = np.cumsum([arrays['n_atoms'] for arrays in new.values()])
+        offsets[1:, 1] = np.cumsum([arrays['n_bonds'] for arrays in new.values()])
+        name = f'seg_{time.time_ns()}_{os.getpid()}'
+        tmp_path = os.path.join(self.path, '.tmp_' + name)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'atoms.npy'), np.concatenate(
+            [arrays['f_atoms'].reshape(-1, self.atom_fdim) for arrays in new.values()]))
+        np.save(os.path.join(tmp_path, 'bonds.npy'), np.concatenate(
+            [arrays['f_bonds'].reshape(-1, self.bond_fdim) for arrays in new.values()]))
+        for k in ['b2a', 'b2revb']:
+            np.save(os.path.join(tmp_path, f'{k}.npy'), np.concatenate([arrays[k] for arrays in new.values()]))
+        np.save(os.path.join(tmp_path, 'b2br.npy'), np.concatenate(
+            [np.asarray(arrays['b2br'], dtype=np.int32).reshape(-1, 2) for arrays in new.values()]))
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        json.dump(list(new), open(os.path.join(tmp_path, 'smiles.json'), 'w'))
+        os.rename(tmp_path, os.path.join(self.path, name)) # segments are either complete or not there
+        info(f'wrote {len(new)} graphs to the graph store')
+        self.reload()
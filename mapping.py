@@ -1,7 +1,12 @@
 """
 computes mapping between ROI and RT using Least Absolute Deviation (LAD) regression.
 By default, LAD coefficients are enforced to be non-negative.
+The LAD linear program is solved in-process with HiGHS (scipy); `solver='cbc'` uses PuLP/CBC instead.
 Optionally, mapping can be improved afterwards using Ordinary Least Squares (OLS).
+`IsotonicModel` is a more flexible alternative for setups with many anchors: the monotone (non-decreasing)
+mapping with the least absolute deviation, interpolated linearly between the anchors.
+Fitted models can be saved to JSON without their anchors (`save`) and loaded as predict-only mappers (`load_mapping`).
+`LADModel.update` adds or removes anchors without refitting from scratch (e.g., for new identifications during a batch).
 
 With `ols_discard_if_negative`, coefficients from OLS will only be kept if non-negative:
 >>> LADModel(ols_neg_data, ols_after=True, ols_discard_if_negative=True).no_ols_why
@@ -18,17 +23,65 @@ final coefficients: 2.6, 24.2, -9.3
 OLS can also fail with too few data points
 >>> LADModel(mini_data, ols_after=True, ols_discard_if_negative=True, verbose=False).no_ols_why
 'OLS_FAILED'
+
+On synthetic anchors (quadratic RTs with noise):
+>>> rng = np.random.default_rng(0)
+>>> def synthetic(n):
+...     roi = rng.uniform(0, 10, n)
+...     return pd.DataFrame(dict(roi=roi, rt=1 + 2 * roi + 0.1 * roi ** 2 + rng.normal(0, 0.3, n)))
+>>> anchors, test = synthetic(60), synthetic(2000)
+
+the isotonic mapping is non-decreasing, also when extrapolated
+>>> bool((np.diff(IsotonicModel(anchors).get_mapping(np.linspace(-1, 11, 100))) >= 0).all())
+True
+
+`update` gives the same coefficients as fitting again
+>>> model = LADModel(anchors.iloc[:50], ols_after=True, ols_discard_if_negative=True)
+>>> model = model.update(add=anchors.iloc[50:], remove=anchors.index[:5])
+>>> refit = LADModel(anchors.iloc[5:], ols_after=True, ols_discard_if_negative=True)
+>>> np.allclose(model.lad_coefficients, refit.lad_coefficients), np.allclose(model.coefficients, refit.coefficients)
+(True, True)
+
+saved mappings predict the same after loading
+>>> import os, tempfile
+>>> path = os.path.join(tempfile.mkdtemp(), 'mapping.json')
+>>> model.save(path, model_hash='0123')
+>>> loaded = load_mapping(path)
+>>> np.allclose(loaded.get_mapping(test.roi.values), model.get_mapping(test.roi.values)), loaded.info
+(True, {'model_hash': '0123'})
+
+intervals cover about 1 - alpha of new compounds
+>>> for method in ['conformal', 'cv+', 'bootstrap']:
+...     lower, upper = MappingIntervals(model, method, alpha=0.1).get_intervals(test.roi)
+...     print(method, 0.85 <= np.mean((lower <= test.rt) & (test.rt <= upper)))
+conformal True
+cv+ True
+bootstrap True
+>>> coefficients, residuals = bootstrap_coefficients(model, n_boot=200)
+>>> coefficients.shape, residuals.shape, np.allclose(np.median(coefficients, axis=0), model.coefficients, atol=0.2)
+((200, 3), (200, 55), True)
+
+`fit_mappings` fits each group separately
+>>> doubled = anchors.assign(rt=anchors.rt * 2)
+>>> fits = fit_mappings(pd.concat([anchors.assign(setup='a'), doubled.assign(setup='b')]), 'setup')
+>>> np.allclose(fits.loc['b', ['c_1', 'c_x', 'c_x**2']].values.astype(float), LADModel(doubled).coefficients)
+True
 """
 
 from typing import Literal
+import multiprocessing as mp
+import json
 import numpy as np
-from pulp import LpMinimize, LpProblem, LpVariable, lpSum, getSolver
+import pandas as pd
 from logging import warning, info
 
+class AnchorError(ValueError):
+    """too few (usable) anchors for a mapping or intervals"""
+
 class LADModel:
     def __init__(self, data, void=0, ols_after=False, ols_discard_if_negative=False,
                  ols_drop_mode:Literal['50%', '2*median']='2*median', bases=['1', 'x', 'x**2'],
-                 verbose=False):
+                 verbose=False, solver:Literal['highs', 'cbc']='highs'):
         self.data_input = data
         self.void = void
         self.ols_after = ols_after
@@ -37,6 +90,7 @@ class LADModel:
         self.data = data.copy() if void == 0 else data.loc[data.rt > void]
         self.bases = bases
         self.verbose = verbose
+        self.solver = solver
         self._compute()
 
     def _compute(self):
@@ -79,6 +133,139 @@ class LADModel:
             print('final coefficients:', ', '.join(f'{c:.1f}' for c in self.coefficients))
 
     def _compute_lad_coefficients(self, data, enforce_positive=True):
+        if (self.solver == 'cbc'):
+            return self._compute_lad_coefficients_cbc(data, enforce_positive)
+        from scipy.optimize import linprog
+        # dual of the LAD problem min_c |y - Ac|_1 (s.t. c >= 0): max_d y^T d s.t. A^T d <= 0 (= 0 for free c),
+        # -1 <= d <= 1; much smaller than the primal (k constraints instead of 2n), coefficients are the marginals
+        A = self.basis_matrix(data.roi.values)
+        y = data.rt.values.astype(np.float64)
+        k = A.shape[1]
+        if (enforce_positive):
+            res = linprog(-y, A_ub=A.T, b_ub=np.zeros(k), bounds=(-1, 1), method='highs')
+        else:
+            res = linprog(-y, A_eq=A.T, b_eq=np.zeros(k), bounds=(-1, 1), method='highs')
+        assert res.status == 0, 'LAD solution not optimal'
+        if (enforce_positive):
+            return np.maximum(-res.ineqlin.marginals, 0).tolist()
+        return (-res.eqlin.marginals).tolist()
+
+    @staticmethod
+    def _lad_optimal(A, y, coefficients, tol=1e-8):
+        """whether the (non-negative) `coefficients` are an optimal LAD solution for `A`, `y`: checks the LP
+        optimality conditions, i.e., whether dual values for the anchors with zero residual exist"""
+        from scipy.optimize import linprog
+        c = np.asarray(coefficients, dtype=np.float64)
+        r = y - A @ c
+        zero = np.abs(r) <= tol * (1 + np.abs(y))
+        g = A[~zero].T @ np.sign(r[~zero])
+        # d in [-1, 1] for the zero-residual anchors with A_zero^T d + g <= 0 (= 0 for positive coefficients)
+        pos = c > 0
+        A_zero = A[zero].T
+        res = linprog(np.zeros(zero.sum()), A_ub=A_zero[~pos] if (~pos).any() else None,
+                      b_ub=-g[~pos] if (~pos).any() else None, A_eq=A_zero[pos] if pos.any() else None,
+                      b_eq=-g[pos] if pos.any() else None, bounds=(-1, 1), method='highs')
+        return res.status == 0
+
+    def update(self, add=None, remove=None):
+        """adds anchors (DataFrame like `data`, with index labels not in `data`) and/or removes anchors (index labels
+        of `data`) and updates the coefficients. The LAD problem is only solved again if the current coefficients are
+        not optimal anymore, the OLS refinement is updated with the anchors entering or leaving the OLS subset."""
+        if (self.data is None):
+            raise ValueError('mappings loaded with `load_mapping` have no anchors to update')
+        removed = self.data.index.isin(remove) if remove is not None else np.zeros(len(self.data), dtype=bool)
+        if (add is not None):
+            if (self.void != 0):
+                add = add.loc[add.rt > self.void]
+            if (self.data.index.isin(add.index).any()):
+                raise ValueError('index labels of the added anchors have to be new')
+        if (not hasattr(self, '_ols_sums') and self.ols_after):
+            self._init_ols_sums()
+        self.data = self.data.loc[~removed]
+        if (add is not None and len(add) > 0):
+            self.data = pd.concat([self.data, add])
+        self.data_input = self.data
+        A = self.basis_matrix(self.data.roi.values)
+        y = self.data.rt.values.astype(np.float64)
+        if (not self._lad_optimal(A, y, self.lad_coefficients)):
+            self.lad_coefficients = self._update_lad_coefficients(A, y)
+        self.coefficients = self.lad_coefficients
+        self.no_ols = not self.ols_after
+        self.no_ols_why = None
+        if (self.ols_after):
+            # OLS subset: remove and add the rows whose membership changed
+            old_keep = np.concatenate([self._ols_keep[~removed], np.zeros(len(self.data) - (~removed).sum(), dtype=bool)])
+            A_removed = self._ols_A[removed & self._ols_keep]
+            y_removed = self._ols_y[removed & self._ols_keep]
+            mae = np.abs(A @ np.asarray(self.lad_coefficients) - y)
+            keep = self._ols_subset(mae)
+            XtX, Xty = self._ols_sums
+            XtX = XtX - A_removed.T @ A_removed
+            Xty = Xty - A_removed.T @ y_removed
+            for sign, rows in [(1, keep & ~old_keep), (-1, old_keep & ~keep)]:
+                XtX = XtX + sign * A[rows].T @ A[rows]
+                Xty = Xty + sign * A[rows].T @ y[rows]
+            self._ols_sums = (XtX, Xty)
+            self._ols_keep, self._ols_A, self._ols_y = keep, A, y
+            self.ols_data = self.data.loc[keep].assign(rt_pred=(A @ np.asarray(self.lad_coefficients))[keep],
+                                                       MAE=mae[keep])
+            self.ols_points = self.ols_data
+            if (not self._ols_full_rank(A[keep])):
+                warning('OLS model failed, keeping LAD coefficients')
+                self.no_ols = True
+                self.no_ols_why = 'OLS_FAILED'
+            else:
+                self.ols_coefficients = np.linalg.pinv(XtX) @ Xty
+                if (self.ols_discard_if_negative and (self.ols_coefficients < 0).any()):
+                    self.no_ols = True
+                    self.no_ols_why = 'NEGATIVE_COEFFICIENTS'
+            if (not self.no_ols):
+                self.coefficients = self.ols_coefficients
+        return self
+
+    def _update_lad_coefficients(self, A, y, window=64):
+        """LAD coefficients starting from the current ones: the dual values of the anchors far from the current fit
+        are fixed to the signs of their residuals, only the `window` anchors closest to the fit are optimized.
+        The window is enlarged until the solution is optimal for all anchors."""
+        from scipy.optimize import linprog
+        if (self.solver == 'cbc'):
+            return self._compute_lad_coefficients(self.data)
+        r = y - A @ np.asarray(self.lad_coefficients)
+        order = np.argsort(np.abs(r), kind='stable')
+        while (window < len(y)):
+            inner, outer = order[:window], order[window:]
+            res = linprog(-y[inner], A_ub=A[inner].T, b_ub=-(A[outer].T @ np.sign(r[outer])), bounds=(-1, 1),
+                          method='highs')
+            if (res.status == 0):
+                coefficients = np.maximum(-res.ineqlin.marginals, 0)
+                if (self._lad_optimal(A, y, coefficients)):
+                    return coefficients.tolist()
+            window *= 4
+        return self._compute_lad_coefficients(self.data)
+
+    def _ols_subset(self, mae):
+        if (self.ols_drop_mode == '50%'):
+            keep = np.zeros(len(mae), dtype=bool)
+            keep[np.argsort(mae, kind='stable')[:len(mae) // 2]] = True
+            return keep
+        return mae <= 2 * np.median(mae)
+
+    @staticmethod
+    def _ols_full_rank(A):
+        """whether OLS on the anchors with basis matrix `A` is determined: at least one anchor per basis and
+        no collinear bases (e.g., all anchors with the same ROI); otherwise, the LAD coefficients are kept"""
+        return len(A) >= A.shape[1] and np.linalg.matrix_rank(A) == A.shape[1]
+
+    def _init_ols_sums(self):
+        """sums of the OLS normal equations for the current OLS subset (kept up to date by `update`)"""
+        self._ols_A = self.basis_matrix(self.data.roi.values)
+        self._ols_y = self.data.rt.values.astype(np.float64)
+        self._ols_keep = self._ols_subset(np.abs(self._ols_A @ np.asarray(self.lad_coefficients) - self._ols_y))
+        A, y = self._ols_A[self._ols_keep], self._ols_y[self._ols_keep]
+        self._ols_sums = (A.T @ A, A.T @ y)
+
+    def _compute_lad_coefficients_cbc(self, data, enforce_positive=True):
+        from pulp import LpMinimize, LpProblem, LpVariable, lpSum, getSolver
         model = LpProblem(name='LAD', sense=LpMinimize)
         x = data.roi.values
         y = data.rt.values
@@ -99,6 +286,9 @@ class LADModel:
 
     def _get_ols_refined_coefficients(self, data):
         self.ols_points = data
+        if (not self._ols_full_rank(self.basis_matrix(data.roi.values))):
+            warning('not enough data points for OLS model')
+            return None
         import statsmodels.api as sm
         try:
             X = sm.add_constant(np.stack([self.apply_basis_fun(data.roi, basis) for basis in self.bases], axis=1))
@@ -108,6 +298,41 @@ class LADModel:
         except: # with too few data points: error
             warning('not enough data points for OLS model')
 
+    def fit_args(self):
+        """arguments for fitting the same kind of model to other data"""
+        return dict(void=self.void, ols_after=self.ols_after, ols_discard_if_negative=self.ols_discard_if_negative,
+                    ols_drop_mode=self.ols_drop_mode, bases=self.bases, solver=self.solver)
+
+    def to_dict(self):
+        """fitted mapping without the anchors (see `load_mapping`)"""
+        return dict(type='lad', bases=list(self.bases), coefficients=[float(c) for c in self.coefficients],
+                    lad_coefficients=[float(c) for c in self.lad_coefficients],
+                    fit_args={k: v for k, v in self.fit_args().items() if k != 'bases'},
+                    diagnostics=dict(mapping_diagnostics(self), no_ols_why=self.no_ols_why))
+
+    @classmethod
+    def from_dict(cls, d):
+        """predict-only model (no anchors) from `to_dict`"""
+        model = cls.__new__(cls)
+        model.data_input = model.data = None
+        model.diagnostics = d['diagnostics']
+        model.bases = d['bases']
+        model.coefficients = np.array(d['coefficients'])
+        model.lad_coefficients = np.array(d['lad_coefficients'])
+        for k, v in d['fit_args'].items():
+            setattr(model, k, v)
+        model.no_ols_why = d['diagnostics'].get('no_ols_why')
+        model.no_ols = model.no_ols_why is not None or not model.ols_after
+        model.verbose = False
+        return model
+
+    def save(self, path, **info):
+        """writes `to_dict` (and `info`, e.g., the ROI model hash) to the JSON file `path`"""
+        json.dump(dict(self.to_dict(), **info), open(path, 'w'), indent=2, default=str)
+
+    def basis_matrix(self, x):
+        return np.stack([self.apply_basis_fun(np.asarray(x, dtype=np.float64), basis) for basis in self.bases], axis=1)
+
     def apply_basis_fun(self, x, basis):
         match basis:
             case '1':
@@ -126,3 +351,334 @@ class LADModel:
         for coefficient, basis in zip(self.coefficients, self.bases):
             result += coefficient * self.apply_basis_fun(x, basis)
         return result
+
+class IsotonicModel:
+    """L1 isotonic regression of RT on ROI (same `get_mapping` interface as `LADModel`).
+
+    Fitted in O(n log n) on the anchors sorted by ROI (anchors with the same ROI are ordered by RT).
+    Between the fitted points, the mapping is linear; outside the anchor range it is extrapolated linearly
+    with the mean slope over the anchor range."""
+    def __init__(self, data, void=0, verbose=False):
+        self.data_input = data
+        self.void = void
+        self.data = data.copy() if void == 0 else data.loc[data.rt > void]
+        self.verbose = verbose
+        if (len(self.data) == 0):
+            raise ValueError('no anchors for the mapping')
+        order = np.lexsort((self.data.rt.values, self.data.roi.values))
+        x = self.data.roi.values[order].astype(np.float64)
+        fitted = self.isotonic_l1(self.data.rt.values[order].astype(np.float64))
+        # one knot per ROI, the mapping has to be a function of the ROI
+        self.knots_x, first = np.unique(x, return_index=True)
+        self.knots_y = fitted[(first + np.append(first[1:], len(x)) - 1) // 2] # (fitted values are sorted)
+        self.slope = ((self.knots_y[-1] - self.knots_y[0]) / (self.knots_x[-1] - self.knots_x[0])
+                      if len(self.knots_x) > 1 else 0.)
+        if (self.verbose):
+            print(f'isotonic mapping with {len(self.knots_x)} knots, {len(np.unique(self.knots_y))} levels')
+
+    @staticmethod
+    def isotonic_l1(y):
+        """non-decreasing `z` minimizing sum(|y - z|) (slope trick: max-heap of the breakpoints)"""
+        import heapq
+        heap = []               # negated values, i.e., max-heap
+        z = np.empty_like(y)
+        for i, value in enumerate(y):
+            heapq.heappush(heap, -value)
+            if (-heap[0] > value):
+                heapq.heapreplace(heap, -value)
+            z[i] = -heap[0]
+        # optimal solution from the running maxima: z_i = min(z_i, z_i+1)
+        return np.minimum.accumulate(z[::-1])[::-1]
+
+    def fit_args(self):
+        """arguments for fitting the same kind of model to other data"""
+        return dict(void=self.void)
+
+    def update(self, add=None, remove=None):
+        """adds/removes anchors like `LADModel.update` (fitted again, which is already O(n log n))"""
+        if (self.data is None):
+            raise ValueError('mappings loaded with `load_mapping` have no anchors to update')
+        data = self.data.loc[~self.data.index.isin(remove)] if remove is not None else self.data
+        if (add is not None):
+            if (data.index.isin(add.index).any()):
+                raise ValueError('index labels of the added anchors have to be new')
+            data = pd.concat([data, add])
+        self.__init__(data, verbose=self.verbose, **self.fit_args())
+        return self
+
+    def to_dict(self):
+        """fitted mapping without the anchors (see `load_mapping`)"""
+        return dict(type='isotonic', knots_x=self.knots_x.tolist(), knots_y=self.knots_y.tolist(),
+                    slope=float(self.slope), fit_args=self.fit_args(), diagnostics=mapping_diagnostics(self))
+
+    @classmethod
+    def from_dict(cls, d):
+        """predict-only model (no anchors) from `to_dict`"""
+        model = cls.__new__(cls)
+        model.data_input = model.data = None
+        model.diagnostics = d['diagnostics']
+        model.knots_x = np.array(d['knots_x'], dtype=np.float64)
+        model.knots_y = np.array(d['knots_y'], dtype=np.float64)
+        model.slope = d['slope']
+        model.void = d['fit_args']['void']
+        model.verbose = False
+        return model
+
+    save = LADModel.save
+
+    def get_mapping(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        result = np.interp(x, self.knots_x, self.knots_y)
+        result += np.where(x < self.knots_x[0], (x - self.knots_x[0]) * self.slope, 0)
+        result += np.where(x > self.knots_x[-1], (x - self.knots_x[-1]) * self.slope, 0)
+        return result
+
+def mapping_diagnostics(model):
+    """number of anchors, their ROI range (beyond it, the mapping is extrapolated) and the fit errors"""
+    if (model.data is None):    # loaded with `load_mapping`
+        return {k: v for k, v in model.diagnostics.items() if k != 'no_ols_why'}
+    if (len(model.data) == 0):
+        return dict(n_anchors=0)
+    errors = np.abs(model.data.rt.values - model.get_mapping(model.data.roi.values.astype(np.float64)))
+    return dict(n_anchors=len(model.data), roi_min=float(model.data.roi.min()), roi_max=float(model.data.roi.max()),
+                mae=float(errors.mean()), median_ae=float(np.median(errors)), max_ae=float(errors.max()))
+
+MAPPERS = {'lad': LADModel, 'isotonic': IsotonicModel}
+
+def load_mapping(mapping):
+    """predict-only mapper from a file written by `save` (or the dict); everything else saved with it
+    (e.g., the ROI model hash) is in `info`"""
+    d = mapping if isinstance(mapping, dict) else json.load(open(mapping))
+    model = MAPPERS[d['type']].from_dict(d)
+    model.info = {k: v for k, v in d.items() if k not in model.to_dict()}
+    return model
+
+def _fit_group(args):
+    key, data, lad_args = args
+    try:
+        model = LADModel(data, **lad_args)
+    except Exception as e:
+        return key, len(data), None, None, None, repr(e)
+    return key, len(data), list(model.lad_coefficients), list(model.coefficients), model.no_ols_why, None
+
+def fit_mappings(data, group_cols, n_jobs=1, **lad_args):
+    """fits one `LADModel` (with `lad_args`) for each group of `data` (long DataFrame with `roi`, `rt` and
+    `group_cols`, e.g., dataset and anchor set ID), in `n_jobs` processes.
+
+    Returns a table (one row per group) with the number of anchors `n`, LAD (`lad_<basis>`) and final
+    (`c_<basis>`) coefficients, `no_ols_why` and `error` (exception message if the fit failed)."""
+    if (isinstance(group_cols, str)):
+        group_cols = [group_cols]
+    bases = lad_args.get('bases', ['1', 'x', 'x**2'])
+    groups = ((key, group[['roi', 'rt']], lad_args) for key, group in data.groupby(group_cols, sort=True))
+    n_groups = data.groupby(group_cols).ngroups
+    if (n_jobs > 1 and n_groups > 1):
+        with mp.Pool(n_jobs) as pool:
+            results = list(pool.imap(_fit_group, groups, chunksize=max(1, n_groups // (n_jobs * 4))))
+    else:
+        results = [_fit_group(group) for group in groups]
+    records = []
+    for key, n, lad_coefficients, coefficients, no_ols_why, error in results:
+        record = dict(zip(group_cols, key if isinstance(key, tuple) else (key, )))
+        record['n'] = n
+        for prefix, values in [('lad_', lad_coefficients), ('c_', coefficients)]:
+            record.update({prefix + basis: (values[i] if values is not None else np.nan)
+                           for i, basis in enumerate(bases)})
+        record['no_ols_why'] = no_ols_why
+        record['error'] = error
+        records.append(record)
+    return pd.DataFrame.from_records(records).set_index(group_cols)
+
+def _block_lad_coefficients(As, ys):
+    """LAD coefficients (>= 0) for each of the problems (`As`: samples x n x k, `ys`: samples x n),
+    solved as one block-diagonal LP"""
+    from scipy.optimize import linprog
+    from scipy.sparse import coo_matrix
+    n_boot, n, k = As.shape
+    # dual LAD (see `_compute_lad_coefficients`), one block per problem
+    b, i, j = np.meshgrid(np.arange(n_boot), np.arange(n), np.arange(k), indexing='ij')
+    A_ub = coo_matrix((As.ravel(), ((b * k + j).ravel(), (b * n + i).ravel())), shape=(n_boot * k, n_boot * n)).tocsr()
+    res = linprog(-ys.ravel(), A_ub=A_ub, b_ub=np.zeros(n_boot * k), bounds=(-1, 1), method='highs')
+    assert res.status == 0, 'LAD solution not optimal'
+    return np.maximum(-res.ineqlin.marginals, 0).reshape(n_boot, k)
+
+def _weighted_lad_coefficients(A, y, W, start, max_iter=200):
+    """LAD coefficients for each row of anchor weights `W` (samples x n), starting from the coefficients `start`
+    (e.g., of all anchors) for all samples at once: from the vertex interpolating the k anchors closest to `start`,
+    descent steps along the edges (the anchor violating the optimality conditions most leaves the vertex, the
+    step length is a weighted median of the residual ratios, the anchor there enters) until the vertex is optimal.
+    Returns the coefficients and which are optimal (others, e.g., with coefficients <= 0, have to be solved as LP)."""
+    n_boot, (n, k) = len(W), A.shape
+    C = np.tile(np.asarray(start, dtype=np.float64), (n_boot, 1))
+    basis = np.argpartition(np.where(W > 0, np.abs(y - C @ A.T), np.inf), k - 1, axis=1)[:, :k]
+    A_B = A[basis]              # (n_boot, k, k)
+    regular = np.abs(np.linalg.det(A_B)) > 1e-10 * np.abs(A_B).max(axis=(1, 2)) ** k
+    A_B[~regular] = np.eye(k)
+    C = np.linalg.solve(A_B, y[basis][..., None])[..., 0]
+    optimal = np.zeros(n_boot, dtype=bool)
+    active = np.flatnonzero(regular)
+    rows = np.arange(n_boot)
+    for _ in range(max_iter):
+        if (len(active) == 0):
+            break
+        B, M, w = basis[active], A_B[active], W[active]
+        r = y - C[active] @ A.T
+        signs = np.sign(r) * w
+        np.put_along_axis(signs, B, 0, axis=1)
+        # dual values of the vertex anchors; optimal if within their weights
+        duals = np.linalg.solve(np.transpose(M, (0, 2, 1)), -(signs @ A)[..., None])[..., 0]
+        violation = np.abs(duals) - np.take_along_axis(w, B, axis=1)
+        leaving = violation.argmax(axis=1)
+        done = violation[np.arange(len(active)), leaving] <= 1e-9 * (1 + w.max(axis=1))
+        optimal[active[done]] = True
+        active, B, M, w, r = active[~done], B[~done], M[~done], w[~done], r[~done]
+        leaving, duals = leaving[~done], duals[~done]
+        if (len(active) == 0):
+            break
+        # edge direction: residual of the leaving anchor changes, the other vertex anchors stay interpolated
+        e = np.zeros((len(active), k))
+        e[np.arange(len(active)), leaving] = -np.sign(duals[np.arange(len(active)), leaving])
+        D = np.linalg.solve(M, e[..., None])[..., 0]
+        a = D @ A.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(np.abs(a) > 1e-12, r / a, 0)
+        weights = np.where(np.abs(a) > 1e-12, w * np.abs(a), 0)
+        # step: weighted median of the breakpoints t (minimizes sum w |r - t a|)
+        order = np.argsort(t, axis=1)
+        cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+        entering = order[rows[:len(active)], (cumulative < cumulative[:, -1:] / 2).sum(axis=1)]
+        step = t[rows[:len(active)], entering]
+        C[active] += step[:, None] * D
+        basis[active, leaving] = entering
+        A_B[active] = A[basis[active]]
+    optimal &= regular & (C > 0).all(axis=1)
+    return C, optimal
+
+def bootstrap_coefficients(model, n_boot=1000, seed=0):
+    """coefficients (`n_boot` x bases) of `model` refitted to bootstrap samples of its anchors, and the
+    anchor residuals (`n_boot` x anchors) of each refit. The LAD problems are solved for all samples at once,
+    starting from the coefficients of `model` (see `_weighted_lad_coefficients`), the few that are not optimal
+    then as one block-diagonal LP; the OLS refinement is done for all samples at once."""
+    rng = np.random.default_rng(seed)
+    A = model.basis_matrix(model.data.roi.values)
+    y = model.data.rt.values.astype(np.float64)
+    n, k = A.shape
+    idx = rng.integers(0, n, (n_boot, n))
+    As, ys = A[idx], y[idx]     # (n_boot, n, k), (n_boot, n)
+    counts = np.bincount((idx + n * np.arange(n_boot)[:, None]).ravel(), minlength=n_boot * n).reshape(n_boot, n)
+    C, optimal = _weighted_lad_coefficients(A, y, counts.astype(np.float64), model.lad_coefficients)
+    if (not optimal.all()):
+        info(f'bootstrap: solving {(~optimal).sum()} of {n_boot} LAD problems as LP')
+        C[~optimal] = _block_lad_coefficients(As[~optimal], ys[~optimal])
+    if (model.ols_after):
+        mae = np.abs(np.einsum('bnk,bk->bn', As, C) - ys)
+        if (model.ols_drop_mode == '50%'):
+            keep = np.zeros_like(mae, dtype=bool)
+            np.put_along_axis(keep, np.argsort(mae, axis=1, kind='stable')[:, :n // 2], True, axis=1)
+        else:
+            keep = mae <= 2 * np.median(mae, axis=1, keepdims=True)
+        # least squares on the kept anchors (minimum norm like statsmodels' pinv)
+        XtX = np.einsum('bnk,bn,bnl->bkl', As, keep, As)
+        Xty = np.einsum('bnk,bn,bn->bk', As, keep, ys)
+        C_ols = np.einsum('bkl,bl->bk', np.linalg.pinv(XtX), Xty)
+        use_ols = np.linalg.matrix_rank(As * keep[..., None]) == k # see `LADModel._ols_full_rank`
+        if (model.ols_discard_if_negative):
+            use_ols &= (C_ols >= 0).all(axis=1)
+        C = np.where(use_ols[:, None], C_ols, C)
+    return C, ys - np.einsum('bnk,bk->bn', As, C)
+
+class MappingIntervals:
+    """(1 - `alpha`) prediction intervals for the retention times predicted by a fitted `LADModel`
+    (or `IsotonicModel`, only `conformal`):
+
+    - `conformal`: split-conformal; the model is refitted to a random part of the anchors and the intervals are
+      centered on its predictions, the quantile of the absolute residuals on the other part
+      (`calibration_fraction`) gives the interval width. Covers with probability >= 1 - `alpha`, but needs
+      at least 1/`alpha` - 1 calibration anchors (otherwise unbounded), i.e., 18 anchors for `alpha`=0.1
+    - `cv+`: CV+ (jackknife+ for up to `n_folds` anchors); the model is refitted without each of `n_folds` folds,
+      intervals are quantiles of the refits' predictions ± the residuals of the held-out anchors. Uses all
+      anchors and needs only 1/`alpha` - 1 of them (9 for `alpha`=0.1); coverage is >= 1 - 2`alpha` in theory,
+      usually close to 1 - `alpha`
+    - `bootstrap`: quantiles of the predictions of refits to bootstrap samples of the anchors
+      plus resampled anchor residuals (see `bootstrap_coefficients`)"""
+    def __init__(self, model, method:Literal['conformal', 'cv+', 'bootstrap']='conformal', alpha=0.1, n_boot=1000,
+                 calibration_fraction=0.5, n_folds=10, seed=0):
+        self.model = model
+        self.method = method
+        self.alpha = alpha
+        self.seed = seed
+        if (model.data is None):
+            raise ValueError('intervals need the anchors of the mapping, not available for loaded mappings')
+        if (method == 'conformal'):
+            data = model.data
+            rng = np.random.default_rng(seed)
+            calibration = np.zeros(len(data), dtype=bool)
+            calibration[rng.permutation(len(data))[:int(round(len(data) * calibration_fraction))]] = True
+            n_cal = calibration.sum()
+            if (n_cal == 0 or n_cal == len(data)):
+                raise AnchorError(f'too few anchors ({len(data)}) for conformal intervals')
+            self.split_model = type(model)(data.loc[~calibration], **model.fit_args())
+            residuals = np.abs(data.rt.values[calibration]
+                               - self.split_model.get_mapping(data.roi.values[calibration].astype(np.float64)))
+            level = np.ceil((n_cal + 1) * (1 - alpha)) / n_cal
+            if (level > 1):
+                warning(f'too few calibration anchors ({n_cal}) for alpha={alpha}, intervals are unbounded')
+                self.width = np.inf
+            else:
+                self.width = np.quantile(residuals, level, method='higher')
+        elif (method == 'cv+'):
+            data = model.data
+            n_folds = min(n_folds, len(data))
+            if (n_folds < 2):
+                raise AnchorError(f'too few anchors ({len(data)}) for CV+ intervals')
+            rng = np.random.default_rng(seed)
+            self.folds = rng.permutation(len(data)) % n_folds # fold of each anchor
+            self.fold_models = []
+            self.residuals = np.empty(len(data))
+            for fold in range(n_folds):
+                held_out = self.folds == fold
+                fold_model = type(model)(data.loc[~held_out], **model.fit_args())
+                self.residuals[held_out] = np.abs(data.rt.values[held_out] - fold_model.get_mapping(
+                    data.roi.values[held_out].astype(np.float64)))
+                self.fold_models.append(fold_model)
+            if (np.ceil((1 - alpha) * (len(data) + 1)) > len(data)):
+                warning(f'too few anchors ({len(data)}) for alpha={alpha}, intervals are unbounded')
+        elif (method == 'bootstrap'):
+            if (not isinstance(model, LADModel)):
+                raise NotImplementedError('bootstrap intervals are only implemented for `LADModel`')
+            self.coefficients, self.residuals = bootstrap_coefficients(model, n_boot=n_boot, seed=seed)
+        else:
+            raise NotImplementedError(method)
+
+    def get_intervals(self, x, block_size=10_000):
+        """lower and upper bounds of the retention times for ROIs `x`"""
+        x = np.asarray(x, dtype=np.float64)
+        if (self.method == 'conformal'):
+            rt = self.split_model.get_mapping(x)
+            return rt - self.width, rt + self.width
+        if (self.method == 'cv+'):
+            return self._cv_plus_intervals(x, block_size)
+        rng = np.random.default_rng(self.seed)
+        lower, upper = np.empty_like(x), np.empty_like(x)
+        n_boot, n = self.residuals.shape
+        for start in range(0, len(x), block_size):
+            block = slice(start, start + block_size)
+            preds = self.coefficients @ self.model.basis_matrix(x[block]).T # (n_boot, block)
+            preds += np.take_along_axis(self.residuals, rng.integers(0, n, preds.shape), axis=1)
+            lower[block], upper[block] = np.quantile(preds, [self.alpha / 2, 1 - self.alpha / 2], axis=0)
+        return lower, upper
+
+    def _cv_plus_intervals(self, x, block_size=10_000):
+        n = len(self.residuals)
+        # ranks of the order statistics (1-based) giving the bounds
+        k_lower = int(np.floor(self.alpha * (n + 1)))
+        k_upper = int(np.ceil((1 - self.alpha) * (n + 1)))
+        lower, upper = np.full_like(x, -np.inf), np.full_like(x, np.inf)
+        for start in range(0, len(x), block_size):
+            block = slice(start, start + block_size)
+            preds = np.stack([m.get_mapping(x[block]) for m in self.fold_models])[self.folds] # (anchors, block)
+            if (k_lower >= 1):
+                lower[block] = np.partition(preds - self.residuals[:, None], k_lower - 1, axis=0)[k_lower - 1]
+            if (k_upper <= n):
+                upper[block] = np.partition(preds + self.residuals[:, None], k_upper - 1, axis=0)[k_upper - 1]
+        return lower, upper
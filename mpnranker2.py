@@ -6,21 +6,23 @@ import torch.nn.functional as F
 from torch.optim.lr_scheduler import ExponentialLR
 from torch.utils.data.dataloader import DataLoader
 from torch.utils.data import default_convert
-from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 from torch.nn.modules.linear import Linear
-from evaluate import eval_, eval_detailed
-from utils import Data
 import numpy as np
 import logging
 from functools import reduce
 from torch.utils.data import default_collate, default_convert
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    # training only; slow to import
+    from torch.utils.tensorboard import SummaryWriter
 
 logger = logging.getLogger('twosteprt.mpnranker2')
 info = logger.info
 warning = logger.warning
 
 from utils_newbg import SPECIAL_FEATURES_SIZE
+from dmpnn_graph import batch_indices, take_batch, restore_order, dense_batch
 
 class MPNranker(nn.Module):
     def __init__(self, encoder='dmpnn', extra_features_dim=0, sys_features_dim=0,
@@ -73,77 +75,155 @@ class MPNranker(nn.Module):
         self.ident = Linear(hidden_units[-1], 1)
         self.max_epoch = 0      # track number epochs trained
 
+    def encode(self, graphs):
+        """molecule encodings, [batch_size x encoder size]"""
+        if (self.encoder.name == 'dmpnn'):
+            return self.encoder([graphs])
+        else:
+            raise NotImplementedError(f'{self.encoder} encoder')
+
+    def head(self, enc, extra, sysf):
+        """ranking layers: [encoding, extra features, system features] -> ROI (before sigmoid), [batch_size]"""
+        if (not (hasattr(self, 'no_sys_layers') and self.no_sys_layers)):
+            # encode system x molecule relationships
+            if (hasattr(self, 'sys_blowup') and self.sys_blowup):
+                sysf = F.relu(self.sys_blowup_layer(sysf))
+            enc_pv = torch.cat([enc, extra, sysf], 1)
+            for h in self.hidden_pv:
+                enc_pv = F.relu(h(enc_pv))
+            # apply dropout to last pv layer
+            enc_pv = self.dropout_pv(enc_pv)
+            # now ranking layers: [enc, enc_pv] -> ROI
+            # TODO: backwards compatibility: this did not use to be an option
+            if not hasattr(self, 'res_conn_enc') or self.res_conn_enc:
+                enc = torch.cat([enc, extra, enc_pv], 1)
+            else:
+                enc = torch.cat([extra, enc_pv], 1)
+        else:
+            enc = torch.cat([extra, enc], 1)
+        for h in self.hidden:
+            enc = F.relu(h(enc))
+        # apply dropout to last ranking layer
+        enc = self.dropout_rank(enc)
+        # single ROI value
+        roi = self.ident(enc)
+        return roi.transpose(0, 1)[0]
+
     def forward(self, batch):
         """(1|2|n) x [batch_size x (smiles|graphs), batch_size x extra_features, batch_size x sys_features]"""
         res = []                          # TODO: no lists, just tensor stuff
         for graphs, extra, sysf in batch:       # normally 1 or 2
-            if (self.encoder.name == 'dmpnn'):
-                enc = self.encoder([graphs]) # [batch_size x encoder size]
-            else:
-                raise NotImplementedError(f'{self.encoder} encoder')
-            if (not (hasattr(self, 'no_sys_layers') and self.no_sys_layers)):
-                # encode system x molecule relationships
-                if (hasattr(self, 'sys_blowup') and self.sys_blowup):
-                    sysf = F.relu(self.sys_blowup_layer(sysf))
-                enc_pv = torch.cat([enc, extra, sysf], 1)
-                for h in self.hidden_pv:
-                    enc_pv = F.relu(h(enc_pv))
-                # apply dropout to last pv layer
-                enc_pv = self.dropout_pv(enc_pv)
-                # now ranking layers: [enc, enc_pv] -> ROI
-                # TODO: backwards compatibility: this did not use to be an option
-                if not hasattr(self, 'res_conn_enc') or self.res_conn_enc:
-                    enc = torch.cat([enc, extra, enc_pv], 1)
-                else:
-                    enc = torch.cat([extra, enc_pv], 1)
-            else:
-                enc = torch.cat([extra, enc], 1)
-            for h in self.hidden:
-                enc = F.relu(h(enc))
-            # apply dropout to last ranking layer
-            enc = self.dropout_rank(enc)
-            # single ROI value
-            roi = self.ident(enc)
-            res.append(roi.transpose(0, 1)[0])      # [batch_size]
+            res.append(self.head(self.encode(graphs), extra, sysf))      # [batch_size]
         if (len(res) > 2):
             raise Exception('only one or two molecules are supported for now, not ', len(res))
         # return torch.sigmoid(res[0] - res[1] if len(res) == 2 else res[0])
         return [torch.sigmoid(r) for r in res]
 
+    def encodings_are_system_independent(self):
+        """whether molecule encodings can be shared between chromatographic systems"""
+        return not ((hasattr(self, 'add_sys_features') and self.add_sys_features)
+                    or (hasattr(self, 'include_special_atom_features') and self.include_special_atom_features))
+
+    @staticmethod
+    def resolve_graphs(graphs, graph_store=None):
+        """looks up graphs for SMILES in `graph_store` (other SMILES are featurized by the encoder)"""
+        if (graph_store is None):
+            return graphs
+        return [graph_store[g] if isinstance(g, str) and g in graph_store else g for g in graphs]
+
+    def update_embedding_cache(self, graphs, smiles, embedding_cache, batch_size=8192, prog_bar=False,
+                               graph_store=None, max_batch_atoms=None):
+        """encodes all molecules not yet in `embedding_cache`"""
+        first_occurrence = {}
+        for i, s in enumerate(smiles):
+            if (s not in first_occurrence and s not in embedding_cache):
+                first_occurrence[s] = i
+        if (len(first_occurrence) == 0):
+            return
+        info(f'encoding {len(first_occurrence)} molecules not in the embedding cache')
+        to_encode = list(first_occurrence.items())
+        it = batch_indices([graphs[j] for _, j in to_encode], batch_size, max_batch_atoms)
+        if (prog_bar):
+            it = tqdm(it)
+        with torch.no_grad():
+            for idx in it:
+                batch = take_batch(to_encode, idx)
+                if (self.encoder.name == 'dmpnn'):
+                    from dmpnn_graph import dmpnn_batch
+                    graphs_batch = dmpnn_batch(self.resolve_graphs([graphs[j] for _, j in batch], graph_store))
+                else:
+                    raise NotImplementedError(self.encoder)
+                enc = self.encode(graphs_batch).cpu().detach().numpy()
+                embedding_cache.update(zip([s for s, _ in batch], enc))
+
     def predict(self, graphs, extra, sysf, batch_size=8192,
-                prog_bar=False, ret_features=False):
+                prog_bar=False, ret_features=False, smiles=None, embedding_cache=None, graph_store=None,
+                max_batch_atoms=None):
+        """predicts ROIs. With `smiles` and an `EmbeddingCache`, molecule encodings are reused for known
+        compounds and only the ranking layers are run (not possible when system features are part of the graphs).
+        `graphs` can also be SMILES, which are then looked up in `graph_store`.
+        With `max_batch_atoms`, batches are filled with similarly sized molecules up to this number of atoms
+        (and at most `batch_size` molecules) instead of a fixed number of molecules."""
         if (self.encoder.name == 'dmpnn'):
             self.eval()
         else:
             raise NotImplementedError(self.encoder)
+        if (embedding_cache is not None and smiles is not None):
+            if (self.encodings_are_system_independent()):
+                return self._predict_cached(graphs, extra, sysf, smiles, embedding_cache,
+                                            batch_size=batch_size, prog_bar=prog_bar, ret_features=ret_features,
+                                            graph_store=graph_store, max_batch_atoms=max_batch_atoms)
+            warning('molecule encodings depend on the system features, not using the embedding cache')
         preds = []
         features = []
-        it = range(np.ceil(len(graphs) / batch_size).astype(int))
-        if (prog_bar):
-            it = tqdm(it)
+        batches = batch_indices(graphs, batch_size, max_batch_atoms)
+        it = tqdm(batches) if prog_bar else batches
         with torch.no_grad():
-            for i in it:
-                start = i * batch_size
-                end = i * batch_size + batch_size
-                graphs_batch = graphs[start:end]
+            for idx in it:
+                mols_batch = self.resolve_graphs(take_batch(graphs, idx), graph_store)
                 if (self.encoder.name == 'dmpnn'):
                     from dmpnn_graph import dmpnn_batch
-                    graphs_batch = dmpnn_batch(graphs_batch)
+                    graphs_batch = dmpnn_batch(mols_batch)
                 else:
                     raise NotImplementedError(self.encoder)
-                batch = (graphs_batch, default_convert(extra[start:end]),
-                         default_convert(sysf[start:end]))
+                batch = (graphs_batch, default_convert(dense_batch(take_batch(extra, idx))),
+                         default_convert(dense_batch(take_batch(sysf, idx))))
                 # if (input('pdb') == 'y'):
                 #     import pdb; pdb.set_trace()
                 preds.append(self((batch, ))[0].cpu().detach().numpy())
                 if (ret_features):
-                    if (isinstance(graphs[0], str)):
-                        features.extend([self.encoder([[g]]) for g in graphs[start:end]])
+                    if (isinstance(mols_batch[0], str)):
+                        features.append(np.concatenate([self.encoder([[g]]) for g in mols_batch]))
                     else:
-                        features.extend([self.encoder([g]) for g in graphs[start:end]])
+                        features.append(np.concatenate([self.encoder([g]) for g in mols_batch]))
+        if (ret_features):
+            return (restore_order(preds, batches),
+                    restore_order(features, batches))
+        return restore_order(preds, batches)
+
+    def _predict_cached(self, graphs, extra, sysf, smiles, embedding_cache, batch_size=8192,
+                        prog_bar=False, ret_features=False, graph_store=None, max_batch_atoms=None):
+        self.update_embedding_cache(graphs, smiles, embedding_cache, batch_size=batch_size, prog_bar=prog_bar,
+                                    graph_store=graph_store, max_batch_atoms=max_batch_atoms)
+        preds = []
+        features = []
+        it = range(np.ceil(len(smiles) / batch_size).astype(int))
+        if (prog_bar):
+            it = tqdm(it)
+        with torch.no_grad():
+            for i in it:
+                start = i * batch_size
+                end = i * batch_size + batch_size
+                enc = embedding_cache.get_many(smiles[start:end])
+                roi = self.head(default_convert(enc), default_convert(dense_batch(extra[start:end])),
+                                default_convert(dense_batch(sysf[start:end])))
+                preds.append(torch.sigmoid(roi).cpu().detach().numpy())
+                if (ret_features):
+                    features.append(enc)
         if (ret_features):
             return np.concatenate(preds), np.concatenate(features)
         return np.concatenate(preds)
+
     def loss_step(self, x, y, weights, loss_fun):
         pred = self(x)
         if isinstance(loss_fun, nn.MarginRankingLoss):
@@ -155,15 +235,17 @@ class MPNranker(nn.Module):
 
 def train(ranker: MPNranker, bg: DataLoader, epochs=2,
           epochs_start=0,
-          writer:SummaryWriter=None, val_g: DataLoader=None,
-          epsilon=0.5, val_writer:SummaryWriter=None,
-          confl_writer:SummaryWriter=None,
+          writer:'SummaryWriter'=None, val_g: DataLoader=None,
+          epsilon=0.5, val_writer:'SummaryWriter'=None,
+          confl_writer:'SummaryWriter'=None,
           steps_train_loss=10, steps_val_loss=100,
           batch_size=8192, sigmoid_loss=False,
           margin_loss=0.1, early_stopping_patience=None,
           ep_save=False, learning_rate=1e-3, adaptive_lr=False,
           gradient_clip=5, no_encoder_train=False,
-          accs=True, confl_images=False, eval_train_all=True):
+          accs=True, confl_images=False, eval_train_all=True,
+          graph_store=None, max_batch_atoms=None):
+    from evaluate import eval_, eval_detailed
     if (confl_images):
         from rdkit.Chem import Draw
         from PIL import ImageDraw
@@ -259,7 +341,8 @@ def train(ranker: MPNranker, bg: DataLoader, epochs=2,
                     train_acc, stats_i = eval_detailed([bg.dataset.x_ids[i] for i in ds_indices],
                         bg.dataset.y[ds_indices], ranker.predict(
                         bg.dataset.x_mols[ds_indices], bg.dataset.x_extra[ds_indices],
-                            bg.dataset.x_sys[ds_indices], batch_size=batch_size), epsilon=epsilon,
+                            bg.dataset.x_sys[ds_indices], batch_size=batch_size, graph_store=graph_store,
+                            max_batch_atoms=max_batch_atoms), epsilon=epsilon,
                                                        void_rt=bg.dataset.void_info[ds])
                     if (not np.isnan(train_acc)):
                         train_accs.append(train_acc)
@@ -288,7 +371,8 @@ def train(ranker: MPNranker, bg: DataLoader, epochs=2,
                 train_acc = np.nan
             if (eval_train_all):
                 train_acc_all = eval_(bg.dataset.y, ranker.predict(
-                    bg.dataset.x_mols, bg.dataset.x_extra, bg.dataset.x_sys, batch_size=batch_size), epsilon=epsilon)
+                    bg.dataset.x_mols, bg.dataset.x_extra, bg.dataset.x_sys, batch_size=batch_size,
+                    graph_store=graph_store, max_batch_atoms=max_batch_atoms), epsilon=epsilon)
                 writer.add_scalar('acc_all', train_acc_all, iter_count)
             else:
                 train_acc_all = np.nan
@@ -304,7 +388,8 @@ def train(ranker: MPNranker, bg: DataLoader, epochs=2,
                         val_acc, stats_i = eval_detailed([val_g.dataset.x_ids[i] for i in ds_indices],
                             val_g.dataset.y[ds_indices], ranker.predict(
                             val_g.dataset.x_mols[ds_indices], val_g.dataset.x_extra[ds_indices],
-                                val_g.dataset.x_sys[ds_indices], batch_size=batch_size), epsilon=epsilon,
+                                val_g.dataset.x_sys[ds_indices], batch_size=batch_size, graph_store=graph_store,
+                                max_batch_atoms=max_batch_atoms), epsilon=epsilon,
                                                          void_rt=val_g.dataset.void_info[ds])
                         if (not np.isnan(val_acc)):
                             val_accs.append(val_acc)
@@ -331,7 +416,8 @@ def train(ranker: MPNranker, bg: DataLoader, epochs=2,
                     val_stats = stats_d
                 else:
                     val_acc = eval_(val_g.dataset.y, ranker.predict(val_g.dataset.x_mols, val_g.dataset.x_extra, val_g.dataset.x_sys,
-                                                            batch_size=batch_size), epsilon=epsilon)
+                                                            batch_size=batch_size, graph_store=graph_store,
+                                                            max_batch_atoms=max_batch_atoms), epsilon=epsilon)
                 val_writer.add_scalar('acc', val_acc, iter_count)
                 val_writer.flush()
                 print(f'{val_acc=:.2%}')
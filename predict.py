@@ -8,15 +8,17 @@ from tap import Tap
 from typing import List, Optional, Literal, Tuple, Union
 import pickle
 import io
-import torch
 import yaml
 import sys
 
-from utils import Data
-from mapping import LADModel
+from mapping import LADModel, IsotonicModel, MappingIntervals, AnchorError, load_mapping
+
+# NOTE: torch, chemprop, sklearn and RDKit are imported only when needed (loading the model, preprocessing),
+# keep it that way for fast startup (see `bench_startup.py`)
 
 class DataUnpickler(pickle.Unpickler):
     def find_class(self, module, name):
+        import torch
         if module == 'torch.storage' and name == '_load_from_bytes' and not torch.cuda.is_available():
             return lambda b: torch.load(io.BytesIO(b), map_location='cpu')
         else:
@@ -24,6 +26,11 @@ class DataUnpickler(pickle.Unpickler):
 
 
 def load_model(path: str, all_in_one:bool=False):
+    if (all_in_one and (path.endswith('.onnx') or path.endswith('.ts'))):
+        # exported with `export_model.py`
+        from export_model import ExportedRanker
+        return ExportedRanker(path)
+    import torch
     path = path + '.pt' if not path.endswith('pt') else path
     if (torch.cuda.is_available()):
         model = torch.load(path, weights_only=False)
@@ -43,40 +50,43 @@ def load_model(path: str, all_in_one:bool=False):
     config = json.load(open(f'{path}_config.json'))
     return model, data, config
 
-class PredictArgs(Tap):
-    input_compounds: str                 # TSV file with `smiles` and `rt` columns
-    input_metadata: str                  # yaml file with at least `column.name`, `eluent.A.pH`, and `column.t0` specified
-    model: str                           # model to load
-    gpu: bool = False                    # whether to use GPU for predictions
-    output_anchors: bool = False         # include anchors in output
-    out: Optional[str] = None            # where to write the output (TSV format). If not specified, output will be written to screen.
-    batch_size: int = 256                # adjust according to available VRAM
-    repo_root_folder: str = '../RepoRT/' # location of RepoRT, needed for HSM/Tanaka database
-    verbose: bool = False                # more info on what is being done internally
+# ranking layers of `MPNranker` after the preference encoding; quantizing `hidden_pv` (encoding + system features)
+# changed predicted retention times by up to 4 min on the test files, the D-MPNN encoder stays fp32, too
+QUANTIZED_LAYERS = ['hidden', 'ident']
 
-if __name__ == '__main__':
-    args = PredictArgs().parse_args()
-    if (args.verbose):
-        basicConfig(level=INFO)
-    if (args.gpu):
-        torch.set_default_device('cuda')
+def quantize_model(model):
+    """dynamic int8 quantization of the last linear layers of the ranking head (`QUANTIZED_LAYERS`) for CPU inference;
+    see `check_quantization.py` for the effect on speed and accuracy"""
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+    if (not isinstance(model, torch.nn.Module)):
+        raise ValueError('only torch models can be quantized (not models exported to TorchScript/ONNX)')
+    layers = {name for name in QUANTIZED_LAYERS if hasattr(model, name)}
+    return quantize_dynamic(model, layers, dtype=torch.qint8)
 
-    # load model
-    info('load model...')
-    model = load_model(args.model, all_in_one=True)
-    data_args = model.extra_storage['data_args']
-    data_args['repo_root_folder'] =  args.repo_root_folder
-    sysfeature_scaler = model.extra_storage['sysfeature_scaler']
+def load_metadata(path_or_buffer):
+    """reads chromatographic setup from YAML and flattens it (`column.name`, `eluent.A.pH`, ...)"""
+    if (isinstance(path_or_buffer, str)):
+        path_or_buffer = open(path_or_buffer)
+    metadata = yaml.load(path_or_buffer, yaml.SafeLoader)
+    [metadata] = pd.json_normalize(metadata, sep='.').to_dict(orient='records')
+    return metadata
 
+def preprocess(model, compounds, metadata, repo_root_folder='../RepoRT/', name=None, graph_cache=None,
+               graph_workers=1):
+    """builds `Data` for the compounds (DataFrame or TSV path) and returns it together with
+    graphs, extra features and system features in the order used for prediction.
+    `d.df` keeps the row labels of the input (e.g., for joining outputs of several runs)"""
+    from utils import Data
+    data_args = dict(model.extra_storage['data_args'])
+    data_args['repo_root_folder'] = repo_root_folder
+    sysfeature_scaler = model.extra_storage['sysfeature_scaler']
     info('load input data...')
     d = Data(**data_args)
-    metadata = yaml.load(open(args.input_metadata), yaml.SafeLoader)
-    # flatten metadata
-    [metadata] = pd.json_normalize(metadata, sep='.').to_dict(orient='records')
-    original_input_columns = open(args.input_compounds).readlines()[0].strip().split('\t')
-    d.add_external_data(args.input_compounds, metadata=metadata,
+    d.add_external_data(compounds, metadata=metadata,
                         remove_nan_rts=False, tab_mode=True,
-                        isomeric=True, split_type='evaluate')
+                        isomeric=True, split_type='evaluate', name=name)
+    input_rows = d.df.index
 
     # TODO: warn about missing metadata (or even error?)
 
@@ -84,7 +94,7 @@ if __name__ == '__main__':
     d.compute_features(mode=None, add_descs=False)
 
     info('computing graphs')
-    d.compute_graphs()
+    d.compute_graphs(graph_cache=graph_cache, n_jobs=graph_workers)
     info('(fake) splitting data')
     d.split_data((0, 0))
     if (sysfeature_scaler is not None):
@@ -96,45 +106,412 @@ if __name__ == '__main__':
      (test_graphs, test_x, test_sys, test_y)) = d.get_split_data()
     X = np.concatenate((train_x, test_x, val_x)).astype(np.float32)
     X_sys = np.concatenate((train_sys, test_sys, val_sys)).astype(np.float32)
-    Y = np.concatenate((train_y, test_y, val_y))
-    info(f'done preprocessing. predicting ROIs...')
     graphs = np.concatenate((train_graphs, test_graphs, val_graphs))
+    # merging system parameters (HSM, Tanaka) resets the index, rows stay in order
+    assert len(d.df) == len(input_rows)
+    d.df.index = input_rows
+    return d, graphs, X, X_sys
+
+def predict_rois(model, d, graphs, X, X_sys, batch_size=256, prog_bar=False, embedding_cache=None,
+                 max_batch_atoms=None):
+    """predicts ROIs and stores them (in the original order) as `d.df.roi`.
+    ROIs are only predicted once for each unique (SMILES, features) input."""
+    from utils import unique_inputs
+    smiles_list = d.df.iloc[np.concatenate((d.train_indices, d.test_indices, d.val_indices))]['smiles'].tolist()
+    unique, inverse = unique_inputs(smiles_list, X, X_sys)
+    if (len(unique) < len(smiles_list)):
+        info(f'{len(unique)} unique inputs for {len(smiles_list)} compounds')
+    graphs, X, X_sys = graphs[unique], X[unique], X_sys[unique]
+    smiles_list = [smiles_list[i] for i in unique]
     if (hasattr(model, 'add_sys_features') and model.add_sys_features):
-        from utils_newbg import sysfeature_graph
+        from dmpnn_graph import attach_sysfeatures
         info('add system features to graphs')
-        smiles_list = d.df.iloc[np.concatenate((d.train_indices, d.test_indices, d.val_indices))]['smiles'].tolist()
         assert len(graphs) == len(smiles_list)
         from chemprop.features import set_extra_atom_fdim, set_extra_bond_fdim
         if (model.add_sys_features_mode == 'bond'):
-            set_extra_bond_fdim(train_sys.shape[1])
+            set_extra_bond_fdim(X_sys.shape[1])
         elif (model.add_sys_features_mode == 'atom'):
-            set_extra_atom_fdim(train_sys.shape[1])
+            set_extra_atom_fdim(X_sys.shape[1])
         for i in range(len(graphs)):
-            graphs[i] = sysfeature_graph(smiles_list[i], graphs[i], X_sys[i],
-                                         bond_or_atom=model.add_sys_features_mode)
-    preds = model.predict(graphs, X, X_sys, batch_size=args.batch_size,
-                          ret_features=False, prog_bar=args.verbose)
-    info(f'done predicting ROIs. predicting retention times...')
+            graphs[i] = attach_sysfeatures(graphs[i], X_sys[i], bond_or_atom=model.add_sys_features_mode)
+    preds = model.predict(graphs, X, X_sys, batch_size=batch_size,
+                          ret_features=False, prog_bar=prog_bar, max_batch_atoms=max_batch_atoms,
+                          **(dict(smiles=smiles_list, embedding_cache=embedding_cache)
+                             if embedding_cache is not None else {}))[inverse]
     d.df['roi'] = preds[np.arange(len(d.df.rt))[ # restore correct order
         np.argsort(np.concatenate([d.train_indices, d.test_indices, d.val_indices]))]]
-    # predict retention times right here
+    return d.df.roi
+
+def fit_mapping(data_anchors, mapper='lad'):
+    """model mapping ROIs to retention times: LAD model (`lad`) or isotonic regression (`isotonic`);
+    raises `AnchorError` with too few anchors (LAD: one per basis, i.e., 3; isotonic: 1)"""
+    if (mapper not in ['lad', 'isotonic']):
+        raise NotImplementedError(mapper)
+    min_anchors = 1 if mapper == 'isotonic' else 3
+    if (len(data_anchors) < min_anchors):
+        raise AnchorError(f'{len(data_anchors)} anchors (compounds with retention times after the void time), '
+                          f'the {mapper} mapping needs at least {min_anchors}')
+    if (mapper == 'isotonic'):
+        return IsotonicModel(data_anchors)
+    return LADModel(data_anchors, ols_after=True, ols_discard_if_negative=True, ols_drop_mode='2*median')
+
+def apply_mapping(df, mapping_model, intervals=None, interval_alpha=0.1):
+    """adds `rt_pred` (and `rt_lower`/`rt_upper` with `intervals`: 'conformal', 'cv+' or 'bootstrap', or a
+    `MappingIntervals` instance) to `df`; returns the names of the added columns"""
+    df['rt_pred'] = mapping_model.get_mapping(df.roi)
+    if (intervals is None):
+        return ['rt_pred']
+    if (not isinstance(intervals, MappingIntervals)):
+        intervals = MappingIntervals(mapping_model, intervals, alpha=interval_alpha)
+    df['rt_lower'], df['rt_upper'] = intervals.get_intervals(df.roi.values.astype(np.float64))
+    return ['rt_pred', 'rt_lower', 'rt_upper']
+
+def map_rts(d, metadata, output_columns, output_anchors=False, intervals=None, interval_alpha=0.1, mapper='lad',
+            mapping_model=None, ret_mapping=False):
+    """maps ROIs to retention times using all compounds with retention times as anchors
+    (with `intervals`, see `apply_mapping`, also (1 - `interval_alpha`) prediction intervals).
+    A fitted `mapping_model` (e.g., from `load_mapping`) is used instead of the anchors if given."""
     d.df['roi2'] = d.df.roi ** 2 # for LAD model
     # anchors are all data points with annotated retention time, discarding the void volume
     data_anchors = d.df.loc[d.df.rt > metadata['column.t0']]
     data_to_predict = d.df.loc[pd.isna(d.df.rt)].copy()
-    info(f'building mapping using {len(data_anchors)} anchors, predicting {len(data_to_predict)} retention times...')
-    mapping_model = LADModel(data_anchors, ols_after=True, ols_discard_if_negative=True, ols_drop_mode='2*median')
-    data_to_predict['rt_pred'] = mapping_model.get_mapping(data_to_predict.roi)
-    # TODO: output anchors, too?
+    if (mapping_model is None):
+        info(f'building mapping using {len(data_anchors)} anchors, predicting {len(data_to_predict)} retention times...')
+        mapping_model = fit_mapping(data_anchors, mapper)
+    else:
+        info(f'using the given mapping, predicting {len(data_to_predict)} retention times...')
+    if (intervals is not None and not isinstance(intervals, MappingIntervals)):
+        intervals = MappingIntervals(mapping_model, intervals, alpha=interval_alpha)
+    pred_columns = apply_mapping(data_to_predict, mapping_model, intervals)
     out_df = data_to_predict[
         # [c for c in data_to_predict.columns if any(['smiles' in c, 'inchi' in c.lower(), 'name' in c, c.startswith('rt_pred'), c.startswith('id')])]
-        original_input_columns + ['rt_pred']
+        output_columns + pred_columns
     ]
-    if (args.output_anchors):
-        out_df = pd.concat([data_anchors[original_input_columns], out_df])
-    if (args.out is None):
-        info(f'done. showing output.')
-        out_df.to_csv(sys.stdout, sep='\t')
+    if (output_anchors):
+        # anchors with their mapped retention times, too
+        data_anchors = data_anchors.copy()
+        apply_mapping(data_anchors, mapping_model, intervals)
+        out_df = pd.concat([data_anchors[output_columns + pred_columns], out_df])
+    if (ret_mapping):
+        return out_df, mapping_model
+    return out_df
+
+def write_mapping(mapping_model, path, model_hash, metadata):
+    """saves the fitted mapping (see `mapping.load_mapping`) with the hash of the ROI model and the setup"""
+    mapping_model.save(path, model_hash=model_hash, setup=metadata)
+    info(f'saved mapping to {path}')
+
+def write_rois(d, path, output_columns, model):
+    """saves the ROIs of all compounds (for `remap_rts`) to the TSV `path` and the model hash to `<path>.meta.json`"""
+    from embedding_cache import model_hash
+    columns = output_columns + (['smiles'] if 'smiles' not in output_columns else []) + ['roi']
+    d.df[columns].to_csv(path, sep='\t')
+    json.dump({'model_hash': model_hash(model), 'output_columns': output_columns},
+              open(path + '.meta.json', 'w'), indent=2)
+    info(f'saved ROIs to {path}')
+
+def remap_rts(rois, anchors, metadata, output_anchors=False, intervals=None, interval_alpha=0.1, mapper='lad',
+              save_mapping=None):
+    """maps ROIs saved with `write_rois` (path) to retention times using new anchors (TSV with `smiles`
+    or `smiles.std` and `rt`) without predicting ROIs again; anchors have to be among the saved compounds"""
+    meta = json.load(open(rois + '.meta.json'))
+    output_columns = meta['output_columns']
+    df = pd.read_csv(rois, sep='\t', index_col=0, dtype={'dataset_id': str})
+    anchors = pd.read_csv(anchors, sep='\t', dtype={'dataset_id': str})
+    if ('smiles.std' in anchors.columns):
+        anchors['smiles'] = anchors['smiles.std']
+    anchors = anchors.loc[~pd.isna(anchors.rt), ['smiles', 'rt']].drop_duplicates('smiles')
+    saved_rois = df.drop_duplicates('smiles').set_index('smiles').roi
+    missing = ~anchors.smiles.isin(saved_rois.index)
+    if (missing.any()):
+        warning(f'{missing.sum()} anchors are not among the saved compounds, ignoring them')
+        anchors = anchors.loc[~missing]
+    anchors['roi'] = saved_rois.loc[anchors.smiles].values
+    # anchors are all data points with annotated retention time, discarding the void volume
+    data_anchors = anchors.loc[anchors.rt > metadata['column.t0']]
+    data_to_predict = df.loc[~df.smiles.isin(anchors.smiles)].copy()
+    if ('rt' in data_to_predict.columns):
+        data_to_predict['rt'] = np.nan
+    info(f'building mapping using {len(data_anchors)} anchors, predicting {len(data_to_predict)} retention times...')
+    mapping_model = fit_mapping(data_anchors, mapper)
+    if (save_mapping is not None):
+        write_mapping(mapping_model, save_mapping, meta['model_hash'], metadata)
+    if (intervals is not None):
+        intervals = MappingIntervals(mapping_model, intervals, alpha=interval_alpha)
+    pred_columns = apply_mapping(data_to_predict, mapping_model, intervals)
+    out_df = data_to_predict[output_columns + pred_columns]
+    if (output_anchors):
+        anchor_rows = df.loc[df.smiles.isin(anchors.smiles)].copy()
+        if ('rt' in anchor_rows.columns):
+            anchor_rows['rt'] = anchors.set_index('smiles').rt.loc[anchor_rows.smiles].values
+        apply_mapping(anchor_rows, mapping_model, intervals)
+        out_df = pd.concat([anchor_rows[output_columns + pred_columns], out_df])
+    return out_df
+
+def predict_rts(model, compounds, metadata, repo_root_folder='../RepoRT/', batch_size=256,
+                output_anchors=False, prog_bar=False, embedding_cache=None, graph_cache=None, graph_workers=1,
+                max_batch_atoms=None, save_rois=None, intervals=None, interval_alpha=0.1, mapper='lad',
+                mapping_model=None, save_mapping=None, ret_mapping=False):
+    """full two-step prediction for one chromatographic setup.
+
+    `compounds` is a TSV (path or file-like) with `smiles` and `rt` columns, `metadata` the flattened setup
+    (see `load_metadata`). Returns the output table with `rt_pred`.
+    Graphs and molecule encodings can be shared between calls with `graph_cache` and `embedding_cache`.
+    With `save_rois` (path), ROIs are saved for re-mapping with other anchors (`remap_rts`).
+    With `intervals` ('conformal', 'cv+' or 'bootstrap', see `MappingIntervals`), `rt_lower`/`rt_upper` give (1 - `interval_alpha`) prediction intervals.
+    `mapper` selects the ROI->RT mapping (see `fit_mapping`). With a fitted `mapping_model` (e.g., from
+    `load_mapping`), anchors are not needed (and only predicted with `output_anchors`), rows keep their labels
+    of the input in any case (see `preprocess`); `save_mapping` (path)
+    saves the mapping for later runs, `ret_mapping` returns it together with the output."""
+    name = compounds if isinstance(compounds, str) else None
+    compounds = pd.read_csv(compounds, sep='\t', dtype={'dataset_id': str})
+    original_input_columns = compounds.columns.tolist()
+    if (mapping_model is not None and not output_anchors and 'rt' in compounds.columns):
+        compounds = compounds.loc[pd.isna(compounds.rt)]
+    d, graphs, X, X_sys = preprocess(model, compounds, metadata, repo_root_folder, name=name,
+                                     graph_cache=graph_cache, graph_workers=graph_workers)
+    info(f'done preprocessing. predicting ROIs...')
+    predict_rois(model, d, graphs, X, X_sys, batch_size=batch_size, prog_bar=prog_bar,
+                 embedding_cache=embedding_cache, max_batch_atoms=max_batch_atoms)
+    if (save_rois is not None):
+        write_rois(d, save_rois, original_input_columns, model)
+    info(f'done predicting ROIs. predicting retention times...')
+    out_df, mapping_model = map_rts(d, metadata, original_input_columns, output_anchors=output_anchors,
+                                    intervals=intervals, interval_alpha=interval_alpha, mapper=mapper,
+                                    mapping_model=mapping_model, ret_mapping=True)
+    if (save_mapping is not None):
+        from embedding_cache import model_hash
+        write_mapping(mapping_model, save_mapping, model_hash(model), metadata)
+    if (ret_mapping):
+        return out_df, mapping_model
+    return out_df
+
+def predict_manifest(model, manifest, repo_root_folder='../RepoRT/', batch_size=256,
+                     output_anchors=False, prog_bar=False, embedding_cache=None, graph_workers=1,
+                     graph_cache=None, max_batch_atoms=None, intervals=None, interval_alpha=0.1, mapper='lad'):
+    """runs one prediction for each (`input_compounds`, `input_metadata`, `out`) row of the manifest TSV.
+
+    Graphs and molecule encodings (if independent of the system) are computed only once for all compounds
+    of all jobs (graphs are also kept in `graph_cache`, e.g., a `GraphStore`, if given)."""
+    jobs = pd.read_csv(manifest, sep='\t')
+    missing_columns = {'input_compounds', 'input_metadata', 'out'} - set(jobs.columns)
+    if (len(missing_columns) > 0):
+        raise ValueError(f'manifest {manifest} lacks the columns {", ".join(sorted(missing_columns))}')
+    if (graph_cache is None):
+        graph_cache = {}
+    if (embedding_cache is None and hasattr(model, 'encodings_are_system_independent')
+        and model.encodings_are_system_independent()):
+        # exported models can't encode, encodings with system features can't be shared between jobs
+        from embedding_cache import EmbeddingCache, model_hash
+        embedding_cache = EmbeddingCache(model_hash(model))
+    for i, job in enumerate(jobs.itertuples(index=False)):
+        info(f'[{i + 1}/{len(jobs)}] predicting {job.input_compounds} with {job.input_metadata}')
+        out_df = predict_rts(model, job.input_compounds, load_metadata(job.input_metadata),
+                             repo_root_folder=repo_root_folder, batch_size=batch_size,
+                             output_anchors=output_anchors, prog_bar=prog_bar,
+                             embedding_cache=embedding_cache, graph_cache=graph_cache,
+                             graph_workers=graph_workers, max_batch_atoms=max_batch_atoms,
+                             intervals=intervals, interval_alpha=interval_alpha, mapper=mapper)
+        out_df.to_csv(job.out, sep='\t')
+        info(f'[{i + 1}/{len(jobs)}] saved to {job.out}')
+
+def iter_chunk_predictions(model, compounds, metadata, mapping_model, output_columns, chunk_size=100_000,
+                           repo_root_folder='../RepoRT/', batch_size=256, prog_bar=False, embedding_cache=None,
+                           graph_workers=1, graph_cache=None, max_batch_atoms=None, intervals=None,
+                           skip_smiles=()):
+    """reads the compounds TSV in chunks and yields the predicted retention times for each chunk
+    (with `rt_lower`/`rt_upper` if `intervals`, a `MappingIntervals` instance, is given);
+    rows keep their row numbers in the input, anchors (rows with `rt`) are skipped.
+    As for the whole input at once, only the first row of each SMILES is predicted (across chunks);
+    SMILES in `skip_smiles` are not predicted at all."""
+    seen = set(skip_smiles)
+    for i, chunk in enumerate(pd.read_csv(compounds, sep='\t', dtype={'dataset_id': str}, chunksize=chunk_size)):
+        if ('rt' in chunk.columns):
+            chunk = chunk.loc[pd.isna(chunk.rt)]
+        smiles = chunk['smiles.std' if 'smiles.std' in chunk.columns else 'smiles']
+        chunk = chunk.loc[~smiles.isin(seen) & ~smiles.duplicated()]
+        seen.update(chunk['smiles.std' if 'smiles.std' in chunk.columns else 'smiles'])
+        info(f'chunk {i + 1}: {len(chunk)} rows to predict')
+        if (len(chunk) == 0):
+            continue
+        d, graphs, X, X_sys = preprocess(model, chunk, metadata, repo_root_folder, name=compounds,
+                                         graph_cache=graph_cache, graph_workers=graph_workers)
+        del chunk
+        predict_rois(model, d, graphs, X, X_sys, batch_size=batch_size, prog_bar=prog_bar,
+                     embedding_cache=embedding_cache, max_batch_atoms=max_batch_atoms)
+        del graphs, X, X_sys
+        data_to_predict = d.df.loc[pd.isna(d.df.rt)].copy()
+        pred_columns = apply_mapping(data_to_predict, mapping_model, intervals)
+        yield data_to_predict[output_columns + pred_columns]
+
+def predict_rts_chunked(model, compounds, metadata, out, chunk_size=100_000, repo_root_folder='../RepoRT/',
+                        batch_size=256, output_anchors=False, prog_bar=False, embedding_cache=None,
+                        graph_workers=1, graph_cache=None, max_batch_atoms=None, intervals=None,
+                        interval_alpha=0.1, mapper='lad', mapping_model=None, save_mapping=None):
+    """like `predict_rts`, but memory is bounded by `chunk_size` instead of the input size:
+    the mapping is built from the anchors first, predictions are appended to `out` (path or buffer) chunk by chunk.
+    Duplicates are removed as for the whole input at once (`predict_rts`), so the output is the same."""
+    original_input_columns = pd.read_csv(compounds, sep='\t', nrows=0).columns.tolist()
+    smiles_column = 'smiles.std' if 'smiles.std' in original_input_columns else 'smiles'
+    skip_smiles = set()
+    if (mapping_model is None or output_anchors):
+        info('collecting anchors...')
+        anchors, to_predict = [], set()
+        for chunk in pd.read_csv(compounds, sep='\t', dtype={'dataset_id': str}, chunksize=chunk_size):
+            anchors.append(chunk.loc[~pd.isna(chunk.rt)])
+            to_predict.update(chunk.loc[pd.isna(chunk.rt), smiles_column])
+        anchors = pd.concat(anchors)
+        if (model.extra_storage['data_args'].get('remove_doublets', False)):
+            # compounds with and without retention time are doublets, removed from anchors and predictions
+            skip_smiles = set(anchors[smiles_column])
+            anchors = anchors.loc[~anchors[smiles_column].isin(to_predict)]
+        del to_predict
+        d, graphs, X, X_sys = preprocess(model, anchors, metadata, repo_root_folder, name=compounds,
+                                         graph_cache=graph_cache, graph_workers=graph_workers)
+        predict_rois(model, d, graphs, X, X_sys, batch_size=batch_size, prog_bar=prog_bar,
+                     embedding_cache=embedding_cache, max_batch_atoms=max_batch_atoms)
+        del graphs, X, X_sys
+        d.df['roi2'] = d.df.roi ** 2 # for LAD model
+    if (mapping_model is None or output_anchors):
+        # anchors are all data points with annotated retention time, discarding the void volume
+        data_anchors = d.df.loc[d.df.rt > metadata['column.t0']]
+    if (mapping_model is None):
+        info(f'building mapping using {len(data_anchors)} anchors...')
+        mapping_model = fit_mapping(data_anchors, mapper)
+    if (save_mapping is not None):
+        from embedding_cache import model_hash
+        write_mapping(mapping_model, save_mapping, model_hash(model), metadata)
+    if (intervals is not None):
+        # calibrated once for all chunks
+        intervals = MappingIntervals(mapping_model, intervals, alpha=interval_alpha)
+    header = True
+    if (output_anchors):
+        # with their mapped retention times, as in `map_rts`
+        data_anchors = data_anchors.copy()
+        pred_columns = apply_mapping(data_anchors, mapping_model, intervals)
+        data_anchors[original_input_columns + pred_columns].to_csv(out, sep='\t')
+        header = False
+    for out_df in iter_chunk_predictions(model, compounds, metadata, mapping_model, original_input_columns,
+                                         chunk_size=chunk_size, repo_root_folder=repo_root_folder,
+                                         batch_size=batch_size, prog_bar=prog_bar,
+                                         embedding_cache=embedding_cache, graph_workers=graph_workers,
+                                         graph_cache=graph_cache, max_batch_atoms=max_batch_atoms,
+                                         intervals=intervals, skip_smiles=skip_smiles):
+        out_df.to_csv(out, sep='\t', header=header, mode='w' if header else 'a')
+        header = False
+
+class PredictArgs(Tap):
+    input_compounds: Optional[str] = None # TSV file with `smiles` and `rt` columns
+    input_metadata: Optional[str] = None  # yaml file with at least `column.name`, `eluent.A.pH`, and `column.t0` specified
+    manifest: Optional[str] = None        # instead of `input_compounds`/`input_metadata`/`out`: TSV with these columns, one prediction per row
+    model: Optional[str] = None          # model to load (not needed for `remap`)
+    gpu: bool = False                    # whether to use GPU for predictions
+    output_anchors: bool = False         # include anchors (with their mapped retention times) in output
+    out: Optional[str] = None            # where to write the output (TSV format). If not specified, output will be written to screen.
+    batch_size: int = 256                # adjust according to available VRAM
+    max_batch_atoms: Optional[int] = None # batch similarly sized molecules up to this number of atoms (at most `batch_size` molecules)
+    repo_root_folder: str = '../RepoRT/' # location of RepoRT, needed for HSM/Tanaka database
+    verbose: bool = False                # more info on what is being done internally
+    embedding_cache: Optional[str] = None # directory for caching molecule encodings (reused for all chromatographic setups)
+    chunk_size: Optional[int] = None     # process the input in chunks of this many rows to bound memory usage (for very large inputs)
+    graph_workers: int = 1               # number of processes for computing molecular graphs
+    graph_store: Optional[str] = None    # directory for persisting molecular graphs between runs
+    quantize: bool = False               # dynamic int8 quantization of the last ranking layers (CPU only, not for exported models); test files: no measurable speedup (0.96-1.2x), retention times differ by median 0.08 min (max 0.95), same retention order accuracy
+    save_rois: Optional[str] = None      # also save the predicted ROIs (TSV) for re-mapping with other anchors
+    remap: Optional[str] = None          # instead of predicting: map ROIs saved with `save_rois` using the anchors (`rt`) of `input_compounds`
+    intervals: Optional[Literal['conformal', 'cv+', 'bootstrap']] = None # add prediction intervals (`rt_lower`, `rt_upper`); `conformal` needs >= 2 * (1/alpha - 1) anchors (18 for alpha=0.1), `cv+` >= 1/alpha - 1 (9), otherwise intervals are unbounded
+    interval_alpha: float = 0.1          # intervals cover the true retention time with probability 1 - `interval_alpha`
+    mapper: Literal['lad', 'isotonic'] = 'lad' # ROI->RT mapping: LAD with bases 1, x, x**2 or isotonic regression (for many anchors)
+    save_mapping: Optional[str] = None   # save the fitted ROI->RT mapping (JSON) for later runs
+    load_mapping: Optional[str] = None   # use a mapping saved with `save_mapping` instead of fitting one to the anchors
+
+if __name__ == '__main__':
+    args = PredictArgs().parse_args()
+    if (args.manifest is None and (args.input_compounds is None or args.input_metadata is None)):
+        raise ValueError('either `--manifest` or both `--input_compounds` and `--input_metadata` have to be specified')
+    if (args.model is None and args.remap is None):
+        raise ValueError('`--model` has to be specified')
+    if (args.save_rois is not None and (args.manifest is not None or args.chunk_size is not None)):
+        raise ValueError('`--save_rois` is not supported with `--manifest` or `--chunk_size`')
+    if ((args.save_mapping is not None or args.load_mapping is not None) and args.manifest is not None):
+        raise ValueError('`--save_mapping` and `--load_mapping` are not supported with `--manifest`')
+    if (args.load_mapping is not None and args.remap is not None):
+        raise ValueError('`--load_mapping` can\'t be used with `--remap`, which fits a new mapping')
+    if (args.quantize and args.gpu):
+        raise ValueError('quantized models can only be used on CPU')
+    if (args.quantize and args.model is not None and (args.model.endswith('.onnx') or args.model.endswith('.ts'))):
+        raise ValueError('`--quantize` is not supported for exported (TorchScript/ONNX) models')
+    if (args.verbose):
+        basicConfig(level=INFO)
+    if (args.gpu):
+        import torch
+        torch.set_default_device('cuda')
+
+    if (args.remap is not None):
+        # only the mapping is fitted again, no model needed
+        out_df = remap_rts(args.remap, args.input_compounds, load_metadata(args.input_metadata),
+                           output_anchors=args.output_anchors, intervals=args.intervals,
+                           interval_alpha=args.interval_alpha, mapper=args.mapper,
+                           save_mapping=args.save_mapping)
+        if (args.model is not None):
+            from embedding_cache import model_hash
+            if (model_hash(load_model(args.model, all_in_one=True))
+                != json.load(open(args.remap + '.meta.json'))['model_hash']):
+                warning(f'ROIs in {args.remap} were predicted with a different model than {args.model}')
+        out_df.to_csv(args.out if args.out is not None else sys.stdout, sep='\t')
+        sys.exit(0)
+
+    # load model
+    info('load model...')
+    model = load_model(args.model, all_in_one=True)
+    if (args.quantize):
+        info('quantize model...')
+        model = quantize_model(model)
+    embedding_cache = None
+    if (args.embedding_cache is not None):
+        from embedding_cache import EmbeddingCache, model_hash
+        embedding_cache = EmbeddingCache(model_hash(model), args.embedding_cache)
+    graph_store = None
+    if (args.graph_store is not None):
+        from graph_store import GraphStore
+        graph_store = GraphStore(args.graph_store)
+    mapping_model = None
+    if (args.load_mapping is not None):
+        from embedding_cache import model_hash
+        mapping_model = load_mapping(args.load_mapping)
+        if (mapping_model.info.get('model_hash') != model_hash(model)):
+            warning(f'mapping {args.load_mapping} was fitted to ROIs of a different model than {args.model}')
+    if (args.manifest is not None):
+        predict_manifest(model, args.manifest, repo_root_folder=args.repo_root_folder,
+                         batch_size=args.batch_size, output_anchors=args.output_anchors,
+                         prog_bar=args.verbose, embedding_cache=embedding_cache,
+                         graph_workers=args.graph_workers, graph_cache=graph_store,
+                         max_batch_atoms=args.max_batch_atoms, intervals=args.intervals,
+                         interval_alpha=args.interval_alpha, mapper=args.mapper)
+    elif (args.chunk_size is not None):
+        metadata = load_metadata(args.input_metadata)
+        predict_rts_chunked(model, args.input_compounds, metadata, args.out if args.out is not None else sys.stdout,
+                            chunk_size=args.chunk_size, repo_root_folder=args.repo_root_folder,
+                            batch_size=args.batch_size, output_anchors=args.output_anchors,
+                            prog_bar=args.verbose, embedding_cache=embedding_cache,
+                            graph_workers=args.graph_workers, graph_cache=graph_store,
+                            max_batch_atoms=args.max_batch_atoms, intervals=args.intervals,
+                            interval_alpha=args.interval_alpha, mapper=args.mapper,
+                            mapping_model=mapping_model, save_mapping=args.save_mapping)
     else:
-        info(f'done. saving to {args.out}.')
-        out_df.to_csv(args.out, sep='\t')
+        metadata = load_metadata(args.input_metadata)
+        out_df = predict_rts(model, args.input_compounds, metadata, repo_root_folder=args.repo_root_folder,
+                             batch_size=args.batch_size, output_anchors=args.output_anchors,
+                             prog_bar=args.verbose, embedding_cache=embedding_cache,
+                             graph_workers=args.graph_workers, graph_cache=graph_store,
+                             max_batch_atoms=args.max_batch_atoms, save_rois=args.save_rois,
+                             intervals=args.intervals, interval_alpha=args.interval_alpha,
+                             mapper=args.mapper, mapping_model=mapping_model, save_mapping=args.save_mapping)
+        if (args.out is None):
+            info(f'done. showing output.')
+            out_df.to_csv(sys.stdout, sep='\t')
+        else:
+            info(f'done. saving to {args.out}.')
+            out_df.to_csv(args.out, sep='\t')
+    if (embedding_cache is not None):
+        embedding_cache.save()
@@ -0,0 +1,155 @@
+"""precomputed ROIs of a compound library for one chromatographic setup, for repeated retention time window queries
+(e.g., MS annotation) without running the model again:
+
+    python roi_library.py --model models/twostep_everything_predready.pt --input_compounds library.tsv \\
+        --input_metadata setup.yaml --out library_rois/
+
+The library directory contains the ROIs sorted ascending (`rois.npy`), the SMILES (`smiles.npy`: UTF-8 bytes,
+`smiles_offsets.npy`), the input row of each compound (`rows.npy`) and `meta.json` (model hash, setup).
+All arrays are memory-mapped when loaded with `RoiLibrary`:
+
+    library = RoiLibrary('library_rois/')
+    library.fit_mapping(anchors)          # DataFrame with `smiles` and `rt` of compounds in the library
+    library.query(rt=5.2, tolerance=0.3)  # candidates with predicted retention times in 4.9-5.5
+
+As the ROI->RT mapping is monotone, windows are found by binary search on the ROIs; changing the anchors
+only requires fitting the mapping again.
+"""
+from logging import basicConfig, INFO, info, warning
+from tap import Tap
+import json
+import os
+import numpy as np
+import pandas as pd
+
+class RoiLibraryArgs(Tap):
+    model: str                           # model to load (output of `repackage_model.py`)
+    input_compounds: str                 # TSV file with a `smiles` column (and optionally `rt`)
+    input_metadata: str                  # yaml file with at least `column.name`, `eluent.A.pH`, and `column.t0` specified
+    out: str                             # library directory
+    chunk_size: int = 100_000            # number of compounds predicted at once
+    batch_size: int = 256
+    repo_root_folder: str = '../RepoRT/' # location of RepoRT, needed for HSM/Tanaka database
+    graph_workers: int = 1               # number of processes for computing molecular graphs
+    verbose: bool = False
+
+def build_library(model, compounds, metadata, out, chunk_size=100_000, repo_root_folder='../RepoRT/',
+                  batch_size=256, graph_workers=1, prog_bar=False):
+    """predicts ROIs for all compounds (TSV path) and writes them sorted to the directory `out`"""
+    from predict import preprocess, predict_rois
+    from embedding_cache import model_hash
+    rois, smiles, rows = [], [], []
+    for i, chunk in enumerate(pd.read_csv(compounds, sep='\t', dtype={'dataset_id': str}, chunksize=chunk_size)):
+        info(f'chunk {i + 1}: {len(chunk)} rows')
+        if ('rt' not in chunk.columns):
+            chunk['rt'] = np.nan
+        d, graphs, X, X_sys = preprocess(model, chunk, metadata, repo_root_folder, name=compounds,
+                                         graph_workers=graph_workers)
+        predict_rois(model, d, graphs, X, X_sys, batch_size=batch_size, prog_bar=prog_bar)
+        rois.append(d.df.roi.values.astype(np.float32))
+        smiles.extend(d.df.smiles.tolist())
+        rows.append(d.df.index.values.astype(np.int64)) # input rows (see `preprocess`)
+    rois = np.concatenate(rois)
+    rows = np.concatenate(rows)
+    order = np.argsort(rois, kind='stable')
+    smiles_bytes = [smiles[i].encode('utf-8') for i in order]
+    offsets = np.zeros(len(smiles_bytes) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in smiles_bytes])
+    os.makedirs(out, exist_ok=True)
+    np.save(os.path.join(out, 'rois.npy'), rois[order])
+    np.save(os.path.join(out, 'rows.npy'), rows[order])
+    np.save(os.path.join(out, 'smiles.npy'), np.frombuffer(b''.join(smiles_bytes), dtype=np.uint8))
+    np.save(os.path.join(out, 'smiles_offsets.npy'), offsets)
+    json.dump({'model_hash': model_hash(model), 'size': len(rois), 'input_compounds': compounds,
+               'metadata': metadata}, open(os.path.join(out, 'meta.json'), 'w'), indent=2, default=str)
+    info(f'wrote ROIs of {len(rois)} compounds to {out}')
+
+class RoiLibrary:
+    """memory-mapped ROI library (see `build_library`) with retention time window queries"""
+    def __init__(self, path, grid_size=10_000):
+        self.path = path
+        self.meta = json.load(open(os.path.join(path, 'meta.json')))
+        self.model_hash = self.meta['model_hash']
+        self.rois = np.load(os.path.join(path, 'rois.npy'), mmap_mode='r')
+        self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+        self.smiles_bytes = np.load(os.path.join(path, 'smiles.npy'), mmap_mode='r')
+        self.smiles_offsets = np.load(os.path.join(path, 'smiles_offsets.npy'), mmap_mode='r')
+        self.grid_size = grid_size
+        self.mapping = None
+        self._index = None
+
+    def __len__(self):
+        return len(self.rois)
+
+    def smiles(self, i):
+        return bytes(self.smiles_bytes[self.smiles_offsets[i]:self.smiles_offsets[i + 1]]).decode('utf-8')
+
+    def index(self):
+        """SMILES -> position (built on first use)"""
+        if (self._index is None):
+            self._index = {}
+            for i in range(len(self)):
+                self._index.setdefault(self.smiles(i), i)
+        return self._index
+
+    def rois_of(self, smiles):
+        """ROIs of the SMILES (NaN if not in the library)"""
+        index = self.index()
+        return np.array([self.rois[index[s]] if s in index else np.nan for s in smiles], dtype=np.float64)
+
+    def fit_mapping(self, anchors, t0=None, mapper='lad'):
+        """fits the ROI->RT mapping (`mapper`, see `predict.fit_mapping`) to `anchors` (DataFrame with `smiles`
+        and `rt`, or `roi` and `rt`); anchors eluting before `t0` (default: `column.t0` of the library setup) are discarded"""
+        from predict import fit_mapping
+        anchors = anchors.copy()
+        if ('roi' not in anchors.columns):
+            anchors['roi'] = self.rois_of(anchors.smiles)
+            if (pd.isna(anchors.roi).any()):
+                warning(f'{pd.isna(anchors.roi).sum()} anchors are not in the library, ignoring them')
+                anchors = anchors.loc[~pd.isna(anchors.roi)]
+        if (t0 is None):
+            t0 = self.meta['metadata'].get('column.t0', 0)
+        anchors = anchors.loc[anchors.rt > t0]
+        info(f'building mapping using {len(anchors)} anchors')
+        self.mapping = fit_mapping(anchors, mapper)
+        # inverse of the (monotone) mapping on a ROI grid
+        if (len(self) > 0):
+            self.roi_grid = np.linspace(float(self.rois[0]), float(self.rois[-1]), self.grid_size)
+        else:
+            self.roi_grid = np.zeros(1)
+        self.rt_grid = np.maximum.accumulate(self.mapping.get_mapping(self.roi_grid))
+        return self.mapping
+
+    def window(self, rt_min, rt_max):
+        """positions (slice) of the compounds with predicted retention times in [`rt_min`, `rt_max`]"""
+        if (self.mapping is None):
+            raise ValueError('no mapping, call `fit_mapping` first')
+        # ROI bounds from the grid, widened by one grid step; exact filtering of the borders below
+        step = self.roi_grid[1] - self.roi_grid[0] if len(self.roi_grid) > 1 else 0
+        roi_min = np.interp(rt_min, self.rt_grid, self.roi_grid, left=-np.inf) - step
+        roi_max = np.interp(rt_max, self.rt_grid, self.roi_grid, right=np.inf) + step
+        start = np.searchsorted(self.rois, roi_min, side='left')
+        end = np.searchsorted(self.rois, roi_max, side='right')
+        rts = self.mapping.get_mapping(np.asarray(self.rois[start:end], dtype=np.float64))
+        inside = np.flatnonzero((rts >= rt_min) & (rts <= rt_max))
+        if (len(inside) == 0):
+            return slice(start, start)
+        return slice(start + inside[0], start + inside[-1] + 1)
+
+    def query(self, rt, tolerance):
+        """candidates (`smiles`, `roi`, `rt_pred`, input `row`) with predicted retention time `rt` ± `tolerance`"""
+        positions = self.window(rt - tolerance, rt + tolerance)
+        rois = np.asarray(self.rois[positions], dtype=np.float64)
+        return pd.DataFrame({'smiles': [self.smiles(i) for i in range(positions.start, positions.stop)],
+                             'roi': rois, 'rt_pred': self.mapping.get_mapping(rois),
+                             'row': np.asarray(self.rows[positions])})
+
+if __name__ == '__main__':
+    args = RoiLibraryArgs().parse_args()
+    if (args.verbose):
+        basicConfig(level=INFO)
+    from predict import load_model, load_metadata
+    model = load_model(args.model, all_in_one=True)
+    build_library(model, args.input_compounds, load_metadata(args.input_metadata), args.out,
+                  chunk_size=args.chunk_size, repo_root_folder=args.repo_root_folder,
+                  batch_size=args.batch_size, graph_workers=args.graph_workers, prog_bar=args.verbose)
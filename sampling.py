@@ -1,7 +1,7 @@
 from typing import Literal
 from utils_newbg import RankDataset
 import pickle
-from torch.utils.data import WeightedRandomSampler
+from torch.utils.data import WeightedRandomSampler, RandomSampler, Sampler
 import pandas as pd
 import numpy as np
 import torch
@@ -18,6 +18,43 @@ class CustomWeightedRandomSampler(WeightedRandomSampler):
         rand_tensor = torch.from_numpy(rand_tensor)
         return iter(rand_tensor.tolist())
 
+class AtomBudgetBatchSampler(Sampler):
+    """batch sampler yielding batches of pairs with at most `max_atoms` atoms (of both molecules) and
+    `max_batch_size` pairs, for use with `DataLoader(batch_sampler=..., collate_fn=custom_collate)`.
+    Pairs are drawn from `sampler` (default: random permutation), e.g., a `CustomWeightedRandomSampler`."""
+    def __init__(self, td: RankDataset, max_atoms, max_batch_size=None, sampler=None, generator=None):
+        from dmpnn_graph import graph_n_atoms
+        mol_atoms = np.array([graph_n_atoms(m) for m in td.x_mols], dtype=int)
+        self.sizes = (mol_atoms[np.asarray(td.x1_indices, dtype=int)]
+                      + mol_atoms[np.asarray(td.x2_indices, dtype=int)])
+        self.max_atoms = max_atoms
+        self.max_batch_size = max_batch_size
+        self.sampler = sampler if sampler is not None else RandomSampler(td, generator=generator)
+        self._batches = None
+    def _draw_batches(self):
+        batch = []
+        batch_atoms = 0
+        for i in self.sampler:
+            if (len(batch) > 0 and (batch_atoms + self.sizes[i] > self.max_atoms
+                                    or (self.max_batch_size is not None and len(batch) >= self.max_batch_size))):
+                yield batch
+                batch = []
+                batch_atoms = 0
+            batch.append(i)
+            batch_atoms += self.sizes[i]
+        if (len(batch) > 0):
+            yield batch
+    def __iter__(self):
+        # the batches of an epoch are drawn once, by `__len__` or here
+        batches = self._batches if self._batches is not None else list(self._draw_batches())
+        self._batches = None
+        return iter(batches)
+    def __len__(self):
+        # exact number of batches of the next epoch, which are drawn already
+        if (self._batches is None):
+            self._batches = list(self._draw_batches())
+        return len(self._batches)
+
 def calc_sampling_weights(td: RankDataset, method: Literal['compounds', 'pairs'],
                           cluster_informed=False, sqrt_weights=False, verbose=False):
     sets = pd.DataFrame(dict(sets=[td.dataset_info[i] for i in td.x1_indices]))
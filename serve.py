@@ -0,0 +1,173 @@
+"""long-running prediction service; keeps the (repackaged) model loaded between requests.
+
+Requests are `POST /predict` with a JSON body
+    {"compounds": "<TSV with `smiles` and `rt` columns>",
+     "metadata": "<YAML of the chromatographic setup>" (or an already parsed object),
+     "output_anchors": false,
+     "intervals": null, "interval_alpha": 0.1,       (optional, see `predict.py --intervals`)
+     "mapper": "lad",                                (optional, see `predict.py --mapper`)
+     "mapping": ..., "cache_mapping": "<name>"}      (optional, see below)
+and get the same TSV as `predict.py` as response. `GET /health` can be used to check whether the service is up.
+
+Fitted mappings can be reused for repeat requests with the same setup, which then don't need anchors:
+with `"cache_mapping": "<name>"`, the mapping fitted for the request is kept under this name and can be used
+in later requests with `"mapping": "<name>"`. `"mapping"` can also be a mapping saved with `predict.py --save_mapping`
+(the JSON object); `GET /mapping/<name>` returns a cached mapping in this format.
+"""
+from logging import basicConfig, INFO, info, warning
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import UnixStreamServer
+from tap import Tap
+from typing import Optional
+import pandas as pd
+import io
+import os
+import json
+import traceback
+import torch
+
+from predict import load_model, load_metadata, predict_rts, quantize_model
+from mapping import load_mapping, AnchorError
+from embedding_cache import EmbeddingCache, model_hash
+from graph_store import GraphStore
+
+class ServeArgs(Tap):
+    model: str                           # model to load (output of `repackage_model.py`)
+    host: str = '127.0.0.1'
+    port: int = 8000
+    socket: Optional[str] = None         # listen on this unix socket instead of host/port
+    gpu: bool = False                    # whether to use GPU for predictions
+    batch_size: int = 256                # adjust according to available VRAM
+    max_batch_atoms: Optional[int] = None # batch similarly sized molecules up to this number of atoms (at most `batch_size` molecules)
+    repo_root_folder: str = '../RepoRT/' # location of RepoRT, needed for HSM/Tanaka database
+    verbose: bool = False                # more info on what is being done internally
+    embedding_cache: Optional[str] = None # directory for persisting molecule encodings (always cached in memory)
+    graph_store: Optional[str] = None    # directory for persisting molecular graphs between runs
+    quantize: bool = False               # dynamic int8 quantization of the last ranking layers (CPU only, not for exported models; see `predict.py --quantize`)
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # set by `serve`
+    model = None
+    embedding_cache = None
+    graph_store = None
+    repo_root_folder = '../RepoRT/'
+    batch_size = 256
+    max_batch_atoms = None
+    model_hash = None
+    mappings = {}               # fitted mappings by name
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def send_text(self, code, text, content_type='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if (self.path.rstrip('/') == '/health'):
+            self.send_text(200, 'ok\n')
+        elif (self.path.startswith('/mapping/')):
+            name = self.path[len('/mapping/'):]
+            if (name not in self.mappings):
+                self.send_text(404, f'no mapping {name}\n')
+                return
+            self.send_text(200, json.dumps(dict(self.mappings[name].to_dict(), model_hash=self.model_hash)),
+                           content_type='application/json')
+        else:
+            self.send_text(404, f'unknown path {self.path}\n')
+
+    def do_POST(self):
+        if (self.path.rstrip('/') != '/predict'):
+            self.send_text(404, f'unknown path {self.path}\n')
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if (isinstance(payload['metadata'], str)):
+                metadata = load_metadata(io.StringIO(payload['metadata']))
+            else:
+                [metadata] = pd.json_normalize(payload['metadata'], sep='.').to_dict(orient='records')
+            compounds = io.StringIO(payload['compounds'])
+            mapping_model = payload.get('mapping')
+            if (isinstance(mapping_model, str)):
+                mapping_model = self.mappings[mapping_model]
+            elif (mapping_model is not None):
+                mapping_model = load_mapping(mapping_model)
+                if (mapping_model.info.get('model_hash') != self.model_hash):
+                    raise ValueError('mapping was fitted to ROIs of a different model')
+        except Exception as e:
+            self.send_text(400, f'invalid request: {e!r}\n')
+            return
+        try:
+            out_df, mapping_model = predict_rts(
+                self.model, compounds, metadata, repo_root_folder=self.repo_root_folder,
+                batch_size=self.batch_size, max_batch_atoms=self.max_batch_atoms,
+                output_anchors=payload.get('output_anchors', False), intervals=payload.get('intervals'),
+                interval_alpha=payload.get('interval_alpha', 0.1), mapper=payload.get('mapper', 'lad'),
+                mapping_model=mapping_model, ret_mapping=True,
+                embedding_cache=self.embedding_cache, graph_cache=self.graph_store)
+            if (payload.get('cache_mapping') is not None):
+                self.mappings[payload['cache_mapping']] = mapping_model
+        except AnchorError as e:
+            self.send_text(400, f'invalid request: {e}\n')
+            return
+        except Exception as e:
+            warning(traceback.format_exc())
+            self.send_text(500, f'prediction failed: {e!r}\n')
+            return
+        out = io.StringIO()
+        out_df.to_csv(out, sep='\t')
+        self.send_text(200, out.getvalue(), content_type='text/tab-separated-values')
+
+class UnixHTTPServer(UnixStreamServer):
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, None
+
+def serve(model, host='127.0.0.1', port=8000, socket=None, repo_root_folder='../RepoRT/',
+          batch_size=256, embedding_cache=None, graph_store=None, max_batch_atoms=None):
+    PredictionHandler.model = model
+    PredictionHandler.embedding_cache = embedding_cache
+    PredictionHandler.graph_store = graph_store
+    PredictionHandler.repo_root_folder = repo_root_folder
+    PredictionHandler.batch_size = batch_size
+    PredictionHandler.max_batch_atoms = max_batch_atoms
+    PredictionHandler.model_hash = model_hash(model)
+    if (socket is not None):
+        if (os.path.exists(socket)):
+            os.remove(socket)
+        server = UnixHTTPServer(socket, PredictionHandler)
+        print(f'serving predictions on unix socket {socket}')
+    else:
+        server = HTTPServer((host, port), PredictionHandler)
+        print(f'serving predictions on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('caught interrupt; stopping server')
+    finally:
+        server.server_close()
+        if (embedding_cache is not None):
+            embedding_cache.save()
+        if (socket is not None and os.path.exists(socket)):
+            os.remove(socket)
+
+if __name__ == '__main__':
+    args = ServeArgs().parse_args()
+    if (args.verbose):
+        basicConfig(level=INFO)
+    if (args.gpu):
+        torch.set_default_device('cuda')
+    info('load model...')
+    model = load_model(args.model, all_in_one=True)
+    if (args.quantize):
+        info('quantize model...')
+        model = quantize_model(model)
+    serve(model, host=args.host, port=args.port, socket=args.socket,
+          repo_root_folder=args.repo_root_folder, batch_size=args.batch_size, max_batch_atoms=args.max_batch_atoms,
+          embedding_cache=EmbeddingCache(model_hash(model), args.embedding_cache),
+          graph_store=GraphStore(args.graph_store) if args.graph_store is not None else None)
@@ -20,7 +20,7 @@ from utils import Data
 from features import features, parse_feature_spec
 from evaluate import predict, export_predictions, load_model
 from utils_newbg import RankDataset, check_integrity
-from sampling import CustomWeightedRandomSampler, calc_sampling_weights
+from sampling import CustomWeightedRandomSampler, AtomBudgetBatchSampler, calc_sampling_weights
 
 logger = logging.getLogger('twosteprt')
 info = logger.info
@@ -59,6 +59,7 @@ class TrainArgs(Tap):
     # training
     gpu: bool = False
     batch_size: int = 512
+    max_batch_atoms: Optional[int] = None # batches of pairs with up to this number of atoms (at most `batch_size` pairs)
     epochs: int = 10
     early_stopping_patience: Optional[int] = None # stop training when val loss doesn't improve for this number of times
     test_split: float = 0                         # not needed when testing on exclusive test datasets afterwards
@@ -127,6 +128,8 @@ class TrainArgs(Tap):
     mpn_margin: float = 0.1
     mpn_encoder: Literal['dmpnn'] = 'dmpnn'
     smiles_for_graphs: bool = False # always use SMILES internally, compute graphs only on demand
+    graph_workers: int = 1          # number of processes for computing molecular graphs
+    graph_store: Optional[str] = None # directory for persisting molecular graphs between runs
     mpn_no_residual_connections_encoder: bool = False # last stack for mpn model only takes the encoding convolved with sys features
     mpn_add_sys_features: bool = False                # add sys features to the graphs themselves
     mpn_add_sys_features_mode: Literal['bond', 'atom'] = 'atom' # whether to add sys featues as 'bond' and 'atom' features
@@ -152,7 +155,7 @@ class TrainArgs(Tap):
     # data locations
     repo_root_folder: str = '../RepoRT/' # location of RepoRT
     add_desc_file: str = 'data/qm_merged.csv'
-    cache_file: str = 'cached_descs.pkl'
+    cache_file: str = 'cached_descs.sqlite'
     # output control
     verbose: bool = False
     no_progbar: bool = False
@@ -173,23 +176,19 @@ def generic_run_name():
     return f'twosteproi_{time_str}'
 
 
-def preprocess(data: Data, args: TrainArgs):
+def preprocess(data: Data, args: TrainArgs, graph_store=None):
     data.compute_features(**parse_feature_spec(args.feature_type), n_thr=args.num_features, verbose=args.verbose)
     if (data.train_y is not None):
         # assume everything was computed, split etc. already
         return ((data.train_graphs, data.train_x, data.train_sys, data.train_y),
                 (data.val_graphs, data.val_x, data.val_sys, data.val_y),
                 (data.test_graphs, data.test_x, data.test_sys, data.test_y))
-    if (args.cache_file is not None and hasattr(features, 'write_cache')
-        and features.write_cache):
-        info('writing cache, don\'t interrupt!!')
-        pickle.dump(features.cached, open(args.cache_file, 'wb'))
     if args.debug_onehot_sys:
         sorted_dataset_ids = sorted(set(args.input) | set(args.onehot_test_sets))
         data.compute_system_information(True, sorted_dataset_ids)
     info('done. preprocessing...')
     if (data.graph_mode):
-        data.compute_graphs()
+        data.compute_graphs(graph_cache=graph_store, n_jobs=args.graph_workers)
     data.split_data((args.test_split, args.val_split))
     if (not args.no_standardize):
         data.standardize()
@@ -253,13 +252,13 @@ if __name__ == '__main__':
     y_neg = (args.mpn_loss == 'margin')
     # caching
     if (args.cache_file is not None and args.feature_type != 'None'):
-        features.write_cache = False # flag for reporting changes to cache
-        info('reading in cache...')
-        if (os.path.exists(args.cache_file)):
-            features.cached = pickle.load(open(args.cache_file, 'rb'))
-        else:
-            features.cached = {}
-            info('cache file does not exist yet')
+        from descriptor_cache import DescriptorCache
+        # new descriptor values are written to the cache as soon as they are computed
+        features.cached = DescriptorCache(args.cache_file)
+    graph_store = None
+    if (args.graph_store is not None):
+        from graph_store import GraphStore
+        graph_store = GraphStore(args.graph_store)
     info('reading in data and computing features...')
     # additional data from special files
     void_guesses = {}
@@ -350,7 +349,7 @@ if __name__ == '__main__':
                             set(data.df[['dataset_id', 'column.name']].itertuples(index=False))]))
     ((train_graphs, train_x, train_sys, train_y),
      (val_graphs, val_x, val_sys, val_y),
-     (test_graphs, test_x, test_sys, test_y)) = preprocess(data, args)
+     (test_graphs, test_x, test_sys, test_y)) = preprocess(data, args, graph_store=graph_store)
 
     if (args.mpn_encoder == 'dmpnn'):
         from mpnranker2 import custom_collate
@@ -405,7 +404,8 @@ if __name__ == '__main__':
                             conflicting_smiles_pairs=conflicting_smiles_pairs,
                             confl_weight=args.confl_weight,
                             add_sysfeatures_to_graphs=args.mpn_add_sys_features,
-                            sysfeatures_graphs_mode=args.mpn_add_sys_features_mode)
+                            sysfeatures_graphs_mode=args.mpn_add_sys_features_mode,
+                            graph_store=graph_store)
     valdata = RankDataset(x_mols=val_graphs, x_extra=val_x, x_sys=val_sys,
                           x_ids=data.df.iloc[data.val_indices].smiles.tolist(),
                           y=val_y, x_sys_global_num=data.x_info_global_num,
@@ -432,7 +432,8 @@ if __name__ == '__main__':
                           conflicting_smiles_pairs=conflicting_smiles_pairs,
                           confl_weight=args.confl_weight,
                           add_sysfeatures_to_graphs=args.mpn_add_sys_features,
-                          sysfeatures_graphs_mode=args.mpn_add_sys_features_mode)
+                          sysfeatures_graphs_mode=args.mpn_add_sys_features_mode,
+                          graph_store=graph_store)
     if (args.clean_data or args.check_data):
         print('training data check:')
         stats_train, clean_train, _ = check_integrity(traindata, clean=args.clean_data)
@@ -455,12 +456,21 @@ if __name__ == '__main__':
         sampler_val = CustomWeightedRandomSampler(sampling_weights_val, args.sampling_count, replacement=True)
     else:
         sampler_train = sampler_val = None
-    trainloader = DataLoader(traindata, args.batch_size, shuffle=(not args.sample), sampler=sampler_train,
-                             generator=torch.Generator(device='cuda' if args.gpu else 'cpu'),
-                             collate_fn=custom_collate)
-    valloader = DataLoader(valdata, args.batch_size, shuffle=(not args.sample), sampler=sampler_val,
-                           generator=torch.Generator(device='cuda' if args.gpu else 'cpu'),
-                           collate_fn=custom_collate) if len(valdata) > 0 else None
+    if (args.max_batch_atoms is not None):
+        trainloader = DataLoader(traindata, batch_sampler=AtomBudgetBatchSampler(
+            traindata, args.max_batch_atoms, max_batch_size=args.batch_size, sampler=sampler_train,
+            generator=torch.Generator(device='cuda' if args.gpu else 'cpu')), collate_fn=custom_collate)
+        valloader = DataLoader(valdata, batch_sampler=AtomBudgetBatchSampler(
+            valdata, args.max_batch_atoms, max_batch_size=args.batch_size, sampler=sampler_val,
+            generator=torch.Generator(device='cuda' if args.gpu else 'cpu')),
+                               collate_fn=custom_collate) if len(valdata) > 0 else None
+    else:
+        trainloader = DataLoader(traindata, args.batch_size, shuffle=(not args.sample), sampler=sampler_train,
+                                 generator=torch.Generator(device='cuda' if args.gpu else 'cpu'),
+                                 collate_fn=custom_collate)
+        valloader = DataLoader(valdata, args.batch_size, shuffle=(not args.sample), sampler=sampler_val,
+                               generator=torch.Generator(device='cuda' if args.gpu else 'cpu'),
+                               collate_fn=custom_collate) if len(valdata) > 0 else None
     if ('ranker' not in vars() or ranker is None):    # otherwise loaded already
         if (args.model_type == 'mpn'):
             ranker = MPNranker(encoder=args.mpn_encoder,
@@ -497,7 +507,8 @@ if __name__ == '__main__':
                       adaptive_lr=args.adaptive_learning_rate,
                       no_encoder_train=args.no_encoder_train, ep_save=args.ep_save,
                       eval_train_all=(not args.no_train_acc_all),
-                      accs=(not args.no_train_acc))
+                      accs=(not args.no_train_acc),
+                      graph_store=graph_store, max_batch_atoms=args.max_batch_atoms)
         else:
             raise NotImplementedError(args.model_type)
     except KeyboardInterrupt:
@@ -507,15 +518,15 @@ if __name__ == '__main__':
     if hasattr(ranker, 'predict'):
         train_preds = ranker.predict(train_graphs, train_x.astype(np.float32), train_sys.astype(np.float32),
                                      batch_size=args.batch_size * 2,
-                                     prog_bar=args.verbose)
+                                     prog_bar=args.verbose, graph_store=graph_store,
+                                     max_batch_atoms=args.max_batch_atoms)
         if (len(val_x) > 0):
-            val_preds = ranker.predict(val_graphs, val_x.astype(np.float32), val_sys.astype(np.float32), batch_size=args.batch_size * 2)
+            val_preds = ranker.predict(val_graphs, val_x.astype(np.float32), val_sys.astype(np.float32), batch_size=args.batch_size * 2,
+                                       graph_store=graph_store, max_batch_atoms=args.max_batch_atoms)
         if (len(test_x) > 0):
-            test_preds = ranker.predict(test_graphs, test_x.astype(np.float32), test_sys.astype(np.float32), batch_size=args.batch_size * 2)
+            test_preds = ranker.predict(test_graphs, test_x.astype(np.float32), test_sys.astype(np.float32), batch_size=args.batch_size * 2,
+                                        graph_store=graph_store, max_batch_atoms=args.max_batch_atoms)
             if (args.export_rois):
                 if not os.path.isdir('runs'):
                     os.mkdir('runs')
                 export_predictions(data, test_preds, f'runs/{run_name}_test.tsv', 'test')
-    if (args.cache_file is not None and hasattr(features, 'write_cache') and features.write_cache):
-        print('writing cache, don\'t interrupt!!')
-        pickle.dump(features.cached, open(args.cache_file, 'wb'))
@@ -1,6 +1,5 @@
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 import pickle
 import os
@@ -11,8 +10,6 @@ from time import time
 from datetime import timedelta
 import json
 
-from features import features
-
 logger = logging.getLogger('twosteprt.utils')
 info = logger.info
 warning = logger.warning
@@ -37,14 +34,35 @@ ONE_HOT_COLUMNS = ['Waters ACQUITY UPLC HSS T3', 'Thermo Scientific Hypersil GOL
                    'Thermo Scientific Acclaim RSLC 120 C18', 'Waters ACQUITY Premier BEH C18']
 
 
+def constant_ph(df):
+    """pH of each row if only one constant pH value (not NaN or 0) is found for all parts (`eluent.[A-D].pH`)
+    of the gradient, otherwise NaN"""
+    cols = [f'eluent.{part}.pH' for part in 'ABCD' if f'eluent.{part}.pH' in df.columns]
+    if (len(cols) == 0):
+        return pd.Series(np.nan, index=df.index)
+    values = df[cols].astype(float).to_numpy()
+    values[values == 0] = np.nan
+    lowest, highest = np.fmin.reduce(values, axis=1), np.fmax.reduce(values, axis=1)
+    return pd.Series(np.where(lowest == highest, lowest, np.nan), index=df.index)
+
+
 class Standardizer(StandardScaler):
     def __init__(self):
         super(Standardizer, self).__init__()
     def fit_with_names(self, values, names):
-        self.fit(pd.DataFrame(values, columns=names))
+        if (hasattr(values, 'tocsr')):
+            # sparse (e.g., fingerprints): only scaling, centering would make the features dense
+            self.with_mean = False
+            self.fit(values)
+        else:
+            self.fit(pd.DataFrame(values, columns=names))
         self.names = names
     def transform_with_names(self, values, names):
         assert set(names) == set(self.names), f'different set of features: {sorted(set(names))} vs. {sorted(set(self.names))}'
+        if (hasattr(values, 'tocsr')):
+            order = [list(names).index(n) for n in self.names]
+            back = [list(self.names).index(n) for n in names]
+            return self.transform(values.tocsr()[:, order])[:, back]
         # if other order, adapt
         return pd.DataFrame(self.transform(pd.DataFrame(values, columns=names)[self.names]), columns=self.names)[names].values
 
@@ -111,6 +129,7 @@ def split_arrays(arrays, sizes: tuple, split_info=None, stratify=None):
         test_indices = np.argwhere(np.asarray(split_info) == 'test').ravel()
         val_indices = np.argwhere(np.asarray(split_info) == 'val').ravel()
     else:
+        from sklearn.model_selection import train_test_split
         indices = np.arange(len(arrays[0]))
         train_indices, test_indices = (train_test_split(indices, test_size=sizes[0],
                                                         stratify=stratify)
@@ -159,7 +178,7 @@ class Data:
     metadata_void_rt: bool = True
     remove_void_compounds: bool = False
     void_factor: float = 2
-    cache_file: str = 'cached_descs.pkl'
+    cache_file: str = 'cached_descs.sqlite'
     classes_l_thr: float = 0.005
     classes_u_thr: float = 0.025
     use_usp_codes: bool = False
@@ -221,17 +240,30 @@ class Data:
     #     return columns
 
 
-    def compute_graphs(self):
+    def compute_graphs(self, graph_cache=None, n_jobs=1):
+        """`graph_cache`: dict-like (SMILES -> graph) to look up and store graphs, e.g., shared between several `Data`;
+        `n_jobs`: number of worker processes for building graphs"""
         if (self.smiles_for_graphs):
             self.graphs = self.df.smiles.values
+            if (hasattr(graph_cache, 'add_smiles')):
+                # graphs are looked up on demand, but should only be computed once
+                graph_cache.add_smiles(self.df.smiles.unique(), n_jobs=n_jobs)
         else:
             info(f'computing graphs, {self.encoder} mode')
             t0 = time()
             if (self.encoder == 'dmpnn'):
-                from dmpnn_graph import dmpnn_graph as mol2graph
+                from dmpnn_graph import dmpnn_graphs as mol2graphs
             else:
                 raise NotImplementedError(f'{self.encoder} encoder')
-            graphs_unique = {s: mol2graph(s) for s in self.df.smiles.unique()}
+            smiles_unique = self.df.smiles.unique()
+            graphs_unique = ({s: graph_cache[s] for s in smiles_unique if s in graph_cache}
+                             if graph_cache is not None else {})
+            smiles_new = [s for s in smiles_unique if s not in graphs_unique]
+            graphs_new = dict(zip(smiles_new, mol2graphs(smiles_new, n_jobs=n_jobs)))
+            if (graph_cache is not None):
+                info(f'{len(graphs_unique)} of {len(smiles_unique)} graphs found in cache')
+                graph_cache.update(graphs_new)
+            graphs_unique.update(graphs_new)
             self.graphs = np.array([graphs_unique[s] for s in self.df.smiles])
             info(f'computing graphs done ({str(timedelta(seconds=time() - t0))} elapsed)')
 
@@ -248,9 +280,9 @@ class Data:
                 'features are already computed and `recompute` is not specified, do nothing'
             )
             return
-        smiles_unique = list(set(self.df.smiles))
-        smiles_pos = [smiles_unique.index(s) for s in self.df.smiles]
-        features_unique, self.descriptors = features(smiles_unique, filter_=filter_features, verbose=verbose,
+        from features import features
+        smiles_pos, smiles_unique = pd.factorize(self.df.smiles)
+        features_unique, self.descriptors = features(list(smiles_unique), filter_=filter_features, verbose=verbose,
                                                      custom_features=self.custom_features, mode=mode,
                                                      add_descs=add_descs, add_desc_file=add_desc_file)
         self.x_features = features_unique[smiles_pos]
@@ -481,11 +513,9 @@ class Data:
             column_information = pd.read_csv(os.path.join(
                 os.path.dirname(primary_path), f'{dataset_id}_metadata.tsv'),
                 sep='\t')
-            column_information['dataset_id'] = [str(x).rjust(4, '0') for x in column_information['id']]
+            column_information['dataset_id'] = column_information['id'].astype(str).str.rjust(4, '0')
             # NOTE: only set when only one constant pH value is found for all parts of the gradient
-            column_information['ph'] = [ph_desc[0] if len(
-                ph_desc:=(list(set([x for x in r[['eluent.A.pH', 'eluent.B.pH', 'eluent.C.pH', 'eluent.D.pH']] if not np.isnan(x) and x != 0]))))
-                                        == 1 else np.nan for i, r in column_information.iterrows()]
+            column_information['ph'] = constant_ph(column_information)
             for component in self.mobile_phase_components:
                 column_information[f'has_{component}'] = float((column_information[
                     [c for c in column_information.columns if c in [f'eluent.{part}.{component}' for part in 'ABCD']]].sum() > 0).any())
@@ -533,9 +563,16 @@ class Data:
 
     def add_external_data(self, data_path,
                           metadata_void_rt=True, void_rt=0.0, isomeric=True, split_type='train', tab_mode=True,
-                          remove_nan_rts=True, metadata=None):
+                          remove_nan_rts=True, metadata=None, name=None):
+        """`data_path` can also be a file-like object or an already loaded DataFrame;
+        `name` is used as (dummy) dataset ID and defaults to `data_path`"""
         global REL_ONEHOT_COLUMNS
-        df = pd.read_csv(data_path, sep='\t' if tab_mode else ',', dtype={'dataset_id': str})
+        if (isinstance(data_path, pd.DataFrame)):
+            df = data_path.copy()
+        else:
+            df = pd.read_csv(data_path, sep='\t' if tab_mode else ',', dtype={'dataset_id': str})
+        if (name is None):
+            name = data_path if isinstance(data_path, str) else 'external'
         if ('smiles.std' in df.columns):
             df['smiles'] = df['smiles.std']
         if (metadata is not None):
@@ -552,18 +589,15 @@ class Data:
         # get dataset ID(s) and void time(s)
         if ('dataset_id' not in df.columns):
             # add dummy dataset_id
-            df['dataset_id'] = data_path
+            df['dataset_id'] = name
         if ('id' not in df.columns):
             # add dummy ID
-            df['id'] = [f'{r.dataset_id}_external{i}' for i, r in df.iterrows()]
+            df['id'] = df.dataset_id.astype(str) + '_external' + df.index.astype(str)
         if (not metadata_void_rt or 'column.t0' not in df.columns):
             df['column.t0'] = void_rt
         if self.use_system_information or self.metadata_void_rt:
             # NOTE: only set when only one constant pH value is found for all parts of the gradient
-            df['ph'] = [ph_desc[0] if len(
-                ph_desc:=(list(set([x for x in [r.get(f'eluent.{part}.pH', np.nan) for part in 'ABCD']
-                                    if not np.isnan(x) and x != 0]))))
-                        == 1 else np.nan for i, r in df.iterrows()]
+            df['ph'] = constant_ph(df)
             for component in self.mobile_phase_components:
                 df[f'has_{component}'] = float((df[
                     [c for c in df.columns if c in [f'eluent.{part}.{component}' for part in 'ABCD']]].sum() > 0).any())
@@ -580,14 +614,14 @@ class Data:
         old_len1 = len(df)
         if (self.remove_doublets):
             df = df.drop_duplicates('smiles', keep=False)
-            info(f'{data_path}: removing doublets and duplicates, {old_len0}→{old_len1}→{len(df)}')
+            info(f'{name}: removing doublets and duplicates, {old_len0}→{old_len1}→{len(df)}')
         else:
-            info(f'{data_path}: removing duplicates, {old_len0}→{old_len1}')
+            info(f'{name}: removing duplicates, {old_len0}→{old_len1}')
         if (self.metadata_void_rt and 'column.t0' in df.columns):
             metadata_void_rt_guess = df['column.t0'].iloc[0] * self.void_factor
             void_rt = metadata_void_rt_guess if metadata_void_rt_guess > 0 else void_rt
         self.void_info[df.dataset_id.iloc[0]] = void_rt
-        self.void_info[data_path] = void_rt
+        self.void_info[name] = void_rt
         if (self.remove_void_compounds):
             df = df.loc[df.rt >= void_rt]
         # flag dataset as train/val/test
@@ -727,6 +761,18 @@ class Data:
                 (self.val_graphs, self.val_x, self.val_sys, self.val_y),
                 (self.test_graphs, self.test_x, self.test_sys, self.test_y))
 
+def unique_inputs(smiles, *features):
+    """indices of the first occurrences of unique (SMILES, features) rows (in input order) and the inverse
+    mapping every row to its unique row, i.e., `preds_unique[inverse]` gives predictions for all rows"""
+    codes = pd.factorize(pd.Series(smiles))[0]
+    keys = np.concatenate([codes.reshape(-1, 1).astype(np.float64)]
+                          + [np.asarray(f, dtype=np.float64).reshape(len(codes), -1) for f in features], axis=1)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.reshape(-1)]
+
 def export_predictions(data, preds, out, mode='all'):
     if (mode == 'all'):
         df = pd.DataFrame(data.df.iloc[np.concatenate((data.train_indices, data.test_indices, data.val_indices))])
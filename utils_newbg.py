@@ -35,12 +35,13 @@ def compute_special_features(mol, sysfeatures):
 
 
 def sysfeature_graph(smiles, graph, sysfeatures, bond_or_atom='bond', special_features=False):
-    from dmpnn_graph import dmpnn_graph as mol2graph
+    """`graph` with system features for all bonds/atoms; only special features need the molecule (`smiles`)"""
+    from dmpnn_graph import dmpnn_graph as mol2graph, attach_sysfeatures
     if bond_or_atom == 'bond':
-        return mol2graph(smiles, bond_features_extra=np.array([sysfeatures] * int(graph.n_bonds / 2)))
+        return attach_sysfeatures(graph, sysfeatures, 'bond')
     elif bond_or_atom == 'atom':
         if not special_features:
-            return mol2graph(smiles, atom_features_extra=np.array([sysfeatures] * graph.n_atoms))
+            return attach_sysfeatures(graph, sysfeatures, 'atom')
         else:
             from chemprop.rdkit import make_mol
             mol = make_mol(smiles, False, False, False)
@@ -84,6 +85,7 @@ class RankDataset(Dataset):
     add_sysfeatures_to_graphs: bool=False
     sysfeatures_graphs_mode: Literal['bond', 'atom']='bond'
     include_special_atom_features: bool=False
+    graph_store: Optional[Any]=None               # `GraphStore` for looking up graphs of SMILES in `x_mols`
 
     def __post_init__(self):
         if (isinstance(self.x_extra, np.ndarray)):
@@ -114,7 +116,7 @@ class RankDataset(Dataset):
             if self.include_special_atom_features:
                 print('add special atom features to graphs')
             for i in range(len(self.x_mols)):
-                self.x_mols[i] = sysfeature_graph(self.x_ids[i], self.x_mols[i], self.x_sys[i] if self.add_sysfeatures_to_graphs else None,
+                self.x_mols[i] = sysfeature_graph(self.x_ids[i], self.get_mol(i), self.x_sys[i] if self.add_sysfeatures_to_graphs else None,
                                                   bond_or_atom=self.sysfeatures_graphs_mode,
                                                   special_features=self.include_special_atom_features)
 
@@ -479,12 +481,17 @@ class RankDataset(Dataset):
     def __len__(self):
         return self.y_trans.shape[0]
 
+    def get_mol(self, i):
+        if (self.graph_store is not None and isinstance(self.x_mols[i], str)):
+            return self.graph_store[self.x_mols[i]]
+        return self.x_mols[i]
+
     def __getitem__(self, index):
         # x1_sys == x2_sys for the first `x_info_global_num` features
         # returns ((graph, extra, sys) x 2, y, weight)
-        return (((self.x_mols[self.x1_indices[index]], self.x_extra[self.x1_indices[index]],
+        return (((self.get_mol(self.x1_indices[index]), self.x_extra[self.x1_indices[index]],
                   self.x_sys[self.x1_indices[index]]),
-                 (self.x_mols[self.x2_indices[index]], self.x_extra[self.x2_indices[index]],
+                 (self.get_mol(self.x2_indices[index]), self.x_extra[self.x2_indices[index]],
                   self.x_sys[self.x2_indices[index]])),
                 self.y_trans[index], self.weights[index], self.is_confl[index])
 